@@ -9,14 +9,21 @@ author  : Taiyou Komazawa
 date    : 2022/4/22
 '''
 
+import argparse
+import time
+
 import cv2
 import numpy as np
 
-#ライブラリからEyeとEyeLibとEyesControlServerクラスを読み込む
+#ライブラリからEyeとEyeLibとEyesControlServerクラス、出力先のクラスを読み込む
 from libs.lib_donmas_eye import Eye, EyeLid, EyesControlServer
+from libs.lib_donmas_eye import WindowSink, NullSink, RawFileSink, ShmRingSink
+from libs.lib_donmas_eye import AssetStore, DiskAssetCache
 
 #使用するネットワーク上のポート番号
 PORT = 35000
+#瞳の座標をUDPで受け付けるポート番号(Noneの場合は受け付けない。--udp-portで指定する)
+UDP_PORT = None
 
 #表示する画像の大きさ。現在の設定値はアスペクト比 16:9の画面に合わせている。
 SCREEN_HEIGHT   = 720
@@ -29,6 +36,17 @@ HEIGHT = 270
 HALF_WIDTH = 480
 WIDTH = HALF_WIDTH*2
 
+#眼の画像を表示する大きさで直接描画するかどうか
+#(True:素材を起動時に画面の大きさに合わせて拡大しておく, False:処理用の大きさで描画してから毎フレーム拡大する)
+NATIVE_RENDER = True
+
+#描画のフレームレート[fps]
+FPS = 30.0
+
+#デコード・拡大済みの瞳の画像を保存するディレクトリと、その合計の大きさの上限[bytes]
+ASSET_CACHE_DIR = 'asset_cache/'
+ASSET_CACHE_BYTES = 1024*1024*1024
+
 #gif映像のどちらを使うか(True:遅い, False:速い)
 EYELID_SLOW_MODE = True
 
@@ -48,6 +66,12 @@ else:
     EYLID_FILE_PATH = 'video/eyelid_fast.gif'
     EYLID_MASK_FILE_PATH = 'video/bin/eyelid_fast.gif'
 
+#素材の拡大率(縦方向, 横方向)
+if NATIVE_RENDER == True:
+    SCALE = (SCREEN_HEIGHT/HEIGHT, SCREEN_WIDTH/WIDTH)
+else:
+    SCALE = 1.0
+
 #背景(白目)を宣言
 bg = 255*np.ones((HEIGHT, WIDTH, 3), dtype=np.uint8)
 
@@ -56,37 +80,114 @@ eyelid_img = cv2.VideoCapture(EYLID_FILE_PATH)
 #まぶたのマスク映像を読み込み
 eyelid_m_img = cv2.VideoCapture(EYLID_MASK_FILE_PATH)
 
+#瞳の画像の素材ストア(同じ内容の画像は一度だけデコードし、次回の起動からはディスクキャッシュから読み込む)
+assets = AssetStore('tmp_img/', cache=DiskAssetCache(ASSET_CACHE_DIR, ASSET_CACHE_BYTES))
+
 #左右の眼のクラスオブジェクトを宣言
-right = Eye(bg, PUPIL_R_FILE_PATHS, min_range=[0, 0],          max_range=[HEIGHT, HALF_WIDTH], th=-18.0)
-left = Eye(bg, PUPIL_L_FILE_PATHS,  min_range=[0, HALF_WIDTH], max_range=[HEIGHT, WIDTH], th=18.0)
+right = Eye(bg, PUPIL_R_FILE_PATHS, min_range=[0, 0],          max_range=[HEIGHT, HALF_WIDTH], th=-18.0, scale=SCALE, assets=assets)
+left = Eye(bg, PUPIL_L_FILE_PATHS,  min_range=[0, HALF_WIDTH], max_range=[HEIGHT, WIDTH], th=18.0, scale=SCALE, assets=assets)
 
 
 #まぶたのクラスオブジェクトを宣言
-eyelid = EyeLid(eyelid_img, eyelid_m_img)
-#コントロールサーバーのクラスオブジェクトを宣言(左右の眼のオブジェクト、まぶたのオブジェクト、使用するポートを引数に渡す)
-eyes_ctrl_server = EyesControlServer(bg, right, left, eyelid, PORT)
-
-#出力ウィンドウを定義(フルスクリーンで表示)
-cv2.namedWindow("eyes_test", cv2.WND_PROP_FULLSCREEN)
-cv2.setWindowProperty("eyes_test", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+eyelid = EyeLid(eyelid_img, eyelid_m_img, scale=SCALE)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ドンマス-アイ サーバー')
+    #出力先(window:フルスクリーンのウィンドウ, null:破棄, raw:生データのファイル書き出し, shm:共有メモリ)
+    parser.add_argument('--sink', choices=['window', 'null', 'raw', 'shm'], default='window',
+                        help='output sink of the rendered frames')
+    parser.add_argument('--output', default='eyes.raw',
+                        help='file (or named pipe) path for the raw sink (bgr24)')
+    parser.add_argument('--shm-name', default='donmas_eye',
+                        help='shared memory name for the shm sink')
+    parser.add_argument('--shm-slots', type=int, default=4,
+                        help='number of frames in the shared memory ring buffer')
+    parser.add_argument('--fps', type=float, default=FPS,
+                        help='target frame rate (0 renders as fast as possible)')
+    parser.add_argument('--frames', type=int, default=0,
+                        help='stop after every face has output this number of frames (0 runs until quit)')
+    #眼に変化がない間も毎フレーム描画する(--sink null --fps 0 で描画処理の最大速度を測る場合など)
+    #(--sink raw, shm の場合は常に毎フレーム描画する)
+    parser.add_argument('--no-skip-idle', action='store_true',
+                        help='redraw every frame even if the eyes have not changed')
+    #1つのプロセスで描画する顔の数(顔ID 1以降の出力先の名前には"_顔ID"を付ける)
+    parser.add_argument('--faces', type=int, default=1,
+                        help='number of faces rendered by this server (addressed by face-id)')
+    #瞳の座標をUDPでも受け付ける(TCPと同じ番号を指定してもよい)
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT,
+                        help='also accept pupil positions over UDP on this port (disabled by default)')
+    return parser.parse_args()
+
+def face_name(name, face_id):
+    if face_id == 0:
+        return name
+    base, dot, ext = name.rpartition('.')
+    if dot and base:
+        return '{0}_{1}.{2}'.format(base, face_id, ext)
+    return '{0}_{1}'.format(name, face_id)
+
+def create_sink(args, face_id=0):
+    if args.sink == 'null':
+        return NullSink()
+    elif args.sink == 'raw':
+        return RawFileSink(face_name(args.output, face_id))
+    elif args.sink == 'shm':
+        return ShmRingSink(face_name(args.shm_name, face_id), (SCREEN_HEIGHT, SCREEN_WIDTH, 3), args.shm_slots)
+    else:
+        #出力ウィンドウを定義(フルスクリーンで表示)
+        return WindowSink(face_name("eyes_test", face_id))
 
 def main():
+    args = parse_args()
+
+    #コントロールサーバーのクラスオブジェクトを宣言(左右の眼のオブジェクト、まぶたのオブジェクト、使用するポートを引数に渡す)
+    eyes_ctrl_server = EyesControlServer(bg, right, left, eyelid, PORT, scale=SCALE, assets=assets, udp_port=args.udp_port)
+
+    #生データ・共有メモリの出力先は一定のフレームレートで読み出されるため、変化がない間も毎フレーム描画して書き出す
+    if args.no_skip_idle or args.sink in ('raw', 'shm'):
+        eyes_ctrl_server.set_skip_idle(False)
+
+    #2つ目以降の顔はデコード済みの瞳とまぶたの画像を共有して追加する
+    for _ in range(1, args.faces):
+        eyes_ctrl_server.add_face(right.clone(), left.clone(), eyelid.clone())
+    sinks = [create_sink(args, face_id) for face_id in range(eyes_ctrl_server.numof_face())]
+
     print('Launch eye server.')
+    #描画スレッドを開始(画面の大きさに拡大した画像はサーバー内のバッファに書き込まれる)
+    if NATIVE_RENDER == True:
+        eyes_ctrl_server.start_render(args.fps)
+    else:
+        eyes_ctrl_server.start_render(args.fps, (SCREEN_WIDTH, SCREEN_HEIGHT))
+
+    #顔ごとに出力先へ書き出したフレーム数
+    frame_cnts = [0 for _ in sinks]
     while True:
-        #眼を描画
-        eyes = eyes_ctrl_server.get_image()
-        #ウィンドウの画像を更新
-        cv2.imshow("eyes_test", cv2.resize(eyes, dsize=(SCREEN_WIDTH, SCREEN_HEIGHT)))
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            eyelid_img.release()
-            eyelid_m_img.release()
-            cv2.destroyAllWindows()
+        #描画スレッドが次の眼を描画するまで待つ(眼に変化がない間は描画されないため、一定時間で入力の確認に戻る)
+        eyes_list = eyes_ctrl_server.wait_frames(timeout=0.1)
+        #出力先の画像を更新(変化のあった顔のみ)
+        if eyes_list is not None:
+            t0 = time.perf_counter()
+            for face_id, (sink, eyes) in enumerate(zip(sinks, eyes_list)):
+                if eyes is not None:
+                    sink.write(eyes)
+                    frame_cnts[face_id] += 1
+            eyes_ctrl_server.record_stage('display', time.perf_counter() - t0)
+
+        if not all([sink.poll() for sink in sinks]):
             print("The 'q' key has been pressed and the main loop has ended.")
             break
+        #全ての顔の出力先が指定されたフレーム数を書き出したら終了する
+        if args.frames > 0 and min(frame_cnts) >= args.frames:
+            print('{0} frames have been rendered and the main loop has ended.'.format(min(frame_cnts)))
+            break
+
+    print('Render stats:', eyes_ctrl_server.get_render_stats())
+    for sink in sinks:
+        sink.close()
+    eyelid_img.release()
+    eyelid_m_img.release()
     eyes_ctrl_server.close()
 
 
 if __name__ == '__main__':
     main()
-
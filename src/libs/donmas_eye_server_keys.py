@@ -37,6 +37,22 @@ class HeaderKey:
         self.mode_bin       = 'bin'
         #追加する表情モードのID
         self.mode_id        = 'mode-id'
+        #描画の処理時間の統計情報の要求(True)
+        self.stats          = 'stats'
+        #制御する顔のID(省略時は0)
+        self.face_id        = 'face-id'
+        #画像パケット->画像のハッシュ値(sha256, binの代わりに送信済みの画像を指定する)
+        self.mode_hash      = 'hash'
+        #サーバーに問い合わせる画像のハッシュ値のリスト
+        self.asset_query    = 'asset-query'
+        #画像の分割パケット(hash, fname, offset, size, binを持つ辞書)
+        self.asset_chunk    = 'asset-chunk'
+        #分割パケット->画像ファイル内の位置[bytes]
+        self.chunk_offset   = 'offset'
+        #分割パケット->画像ファイル全体の大きさ[bytes]
+        self.asset_size     = 'size'
+        #対応している通信形式のバージョン(接続直後に送信する。サーバーが対応していれば同じキーで返される)
+        self.proto_ver      = 'proto-ver'
     #----
 
     # サーバー -> クライアント ----
@@ -44,4 +60,10 @@ class HeaderKey:
         #self.data_id        = 'data-id'
         #使用できる瞳表情モードの数
         self.mode_num       = 'mode-num'
+        #描画の処理時間の統計情報(要求された場合のみ)
+        #self.stats          = 'stats'
+        #問い合わせたハッシュ値のうちサーバーが持っていない画像のハッシュ値のリスト(問い合わせた場合のみ)
+        self.asset_missing  = 'asset-missing'
+        #使用する通信形式のバージョン(要求された場合のみ)
+        #self.proto_ver      = 'proto-ver'
 
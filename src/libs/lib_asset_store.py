@@ -0,0 +1,449 @@
+'''
+素材ストア ライブラリ
+
+受信した瞳の画像(またはgif映像)を内容のハッシュ値(sha256)で管理し、
+同じ内容の素材は一度だけデコード・拡大して、左右の眼や複数の顔で同じ参照を共有するクラスを定義してある。
+デコード・拡大済みの素材はディスク上のキャッシュ(.npy)にも保存でき、再起動後はデコードせずにメモリマップで読み込む。
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import os.path, os
+import json
+import time
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from .lib_donmas_eye_base import FrameStack, to_scale_pair
+
+def asset_digest(data):
+    '''
+    素材のハッシュ値を求める関数
+
+    Parameters
+    ----------
+    data    : bytes
+        画像ファイルの内容
+
+    Returns
+    -------
+    digest  : string
+        sha256のハッシュ値(16進数の文字列)
+    '''
+
+    return hashlib.sha256(data).hexdigest()
+
+#デコード済みの素材をディスクに保存するキャッシュのクラス
+#(キーごとに画像の配列(キー.npy)と、gif映像の場合は各フレームの時刻(キー.json)を保存する)
+class DiskAssetCache:
+
+    def __init__(self, cache_dir='asset_cache/', max_bytes=512*1024*1024):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        cache_dir   : string
+            キャッシュを保存するディレクトリ
+
+        max_bytes   : int
+            キャッシュの合計の大きさの上限[bytes]
+            (超えた場合は最も長く使われていない素材から削除する)
+        '''
+
+        self.cache_dir_ = cache_dir
+        self.max_bytes_ = max_bytes
+        self.mutex_ = threading.Lock()
+
+        try:
+            os.makedirs(self.cache_dir_)
+        except FileExistsError:
+            pass
+
+        #キー -> (大きさ[bytes], 最後に使われた時刻)。起動時はファイルの更新時刻から復元する
+        self.entries_ = {}
+        for fname in os.listdir(self.cache_dir_):
+            key, ext = os.path.splitext(fname)
+            if ext == '.tmp':
+                #書き込み途中で終了したファイル
+                os.remove(os.path.join(self.cache_dir_, fname))
+                continue
+            if ext == '.json' and not os.path.exists(self.paths_(key)[0]):
+                #画像の配列を書き込む前に終了して残った時刻のファイル
+                os.remove(os.path.join(self.cache_dir_, fname))
+                continue
+            if ext != '.npy':
+                continue
+            st = os.stat(os.path.join(self.cache_dir_, fname))
+            self.entries_[key] = (self.size_of_(key), st.st_mtime)
+
+    def __contains__(self, key):
+        with self.mutex_:
+            return key in self.entries_
+
+    def get_size(self):
+        '''
+        キャッシュの合計の大きさを返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        size    : int
+            合計の大きさ[bytes]
+        '''
+
+        with self.mutex_:
+            return sum(size for size, _ in self.entries_.values())
+
+    def load(self, key):
+        '''
+        キャッシュから素材を読み込む関数
+
+        Parameters
+        ----------
+        key     : string
+            素材のキー
+
+        Returns
+        -------
+        asset   : ndarray or FrameStack or None
+            読み込んだ素材(読み取り専用のメモリマップ), キャッシュに無い場合None
+        '''
+
+        with self.mutex_:
+            if key not in self.entries_:
+                return None
+            self.entries_[key] = (self.entries_[key][0], time.time())
+
+        npy_path, json_path = self.paths_(key)
+        try:
+            #np.memmapではなくndarrayとして扱う(メモリマップされた領域はそのまま共有される)
+            frames = np.asarray(np.load(npy_path, mmap_mode='r'))
+            #最後に使われた時刻として更新時刻を更新しておく(再起動後の削除の順番に使う)
+            os.utime(npy_path)
+            if not os.path.exists(json_path):
+                return frames
+            with open(json_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            #壊れたキャッシュは削除して読み直させる
+            self.remove_(key)
+            return None
+
+        return FrameStack(frames, meta['stamps'], meta['duration'])
+
+    def store(self, key, asset):
+        '''
+        素材をキャッシュに保存する関数
+
+        Parameters
+        ----------
+        key     : string
+            素材のキー
+
+        asset   : ndarray or FrameStack
+            保存する素材
+
+        Returns
+        -------
+        None
+        '''
+
+        npy_path, json_path = self.paths_(key)
+
+        #時刻のファイルを先に書き込み、.npyがあれば素材が揃っているようにする
+        #(途中で終了して残った.jsonは次の起動時に削除する)
+        if type(asset) is FrameStack:
+            meta = json.dumps({'stamps': asset.stamps.tolist(), 'duration': float(asset.duration)})
+            self.write_file_(json_path, lambda f: f.write(meta.encode('utf-8')))
+            frames = asset.frames
+        else:
+            frames = asset
+
+        self.write_file_(npy_path, lambda f: np.save(f, np.ascontiguousarray(frames)))
+
+        with self.mutex_:
+            self.entries_[key] = (self.size_of_(key), time.time())
+            self.evict_(key)
+
+    def write_file_(self, path, write):
+        #書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+        #(同じ素材を複数のスレッドが同時に保存しても互いのファイルを壊さないよう、一時ファイル名は毎回別にする)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir_)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict_(self, keep):
+        #合計の大きさが上限を超えている間、最も長く使われていない素材から削除する
+        total = sum(size for size, _ in self.entries_.values())
+        for key, (size, _) in sorted(self.entries_.items(), key=lambda e: e[1][1]):
+            if total <= self.max_bytes_:
+                break
+            if key == keep:
+                continue
+            self.remove_files_(key)
+            del self.entries_[key]
+            total -= size
+
+    def remove_(self, key):
+        with self.mutex_:
+            self.entries_.pop(key, None)
+            self.remove_files_(key)
+
+    def remove_files_(self, key):
+        for path in self.paths_(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def size_of_(self, key):
+        return sum(os.path.getsize(path) for path in self.paths_(key) if os.path.exists(path))
+
+    def paths_(self, key):
+        base = os.path.join(self.cache_dir_, key)
+        return (base + '.npy', base + '.json')
+
+#内容のハッシュ値をキーにデコード済みの素材を保持するクラス
+class AssetStore:
+
+    def __init__(self, tmp_dir='tmp_img/', max_num=64, cache=None):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        tmp_dir     : string
+            gif映像をデコードするために書き出す一時ディレクトリ
+
+        max_num     : int
+            保持する素材の最大数(超えた場合は最も長く使われていない素材から破棄する)
+            破棄しても、眼に登録済みの素材はそのまま使用できる
+
+        cache       : DiskAssetCache
+            デコード・拡大済みの素材を保存するディスクキャッシュ(Noneの場合は使用しない)
+        '''
+
+        self.tmp_dir_ = tmp_dir
+        self.max_num_ = max_num
+        self.cache_ = cache
+
+        #ハッシュ値 -> デコード済みの素材(ndarray or FrameStack)
+        self.decoded_ = OrderedDict()
+        #(ハッシュ値, 拡大率) -> 拡大済みの素材
+        self.prepared_ = {}
+
+        self.mutex_ = threading.Lock()
+
+        try:
+            os.makedirs(self.tmp_dir_)
+        except FileExistsError:
+            pass
+
+    def __contains__(self, digest):
+        with self.mutex_:
+            if digest in self.decoded_:
+                return True
+        return self.cache_ is not None and digest in self.cache_
+
+    def __len__(self):
+        return len(self.decoded_)
+
+    def load_file(self, path):
+        '''
+        画像ファイルを読み込んで素材を登録する関数
+
+        Parameters
+        ----------
+        path    : string
+            画像(またはgif)のファイルパス
+
+        Returns
+        -------
+        digest  : string or None
+            素材のハッシュ値, 読み込めなかった場合None
+        '''
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        return self.put(data, os.path.basename(path))
+
+    def put(self, data, fname=''):
+        '''
+        素材を登録する関数(同じ内容の素材が登録済みであればデコードしない)
+
+        Parameters
+        ----------
+        data    : bytes
+            画像ファイルの内容
+
+        fname   : string
+            画像ファイル名(拡張子が.gifの場合はgif映像としてデコードする)
+
+        Returns
+        -------
+        digest  : string or None
+            素材のハッシュ値, デコードできなかった場合None
+        '''
+
+        digest = asset_digest(data)
+        if self.touch_(digest):
+            return digest
+
+        asset = None
+        if self.cache_ is not None:
+            asset = self.cache_.load(digest)
+        if asset is None:
+            asset = self.decode_(data, fname, digest)
+            if asset is None:
+                return None
+            if self.cache_ is not None:
+                self.cache_.store(digest, asset)
+
+        if type(asset) is np.ndarray:
+            #左右の眼や複数の顔で共有するため読み取り専用にする
+            asset.flags.writeable = False
+
+        self.insert_(digest, asset)
+        return digest
+
+    def put_digest(self, digest):
+        '''
+        ハッシュ値だけで素材を登録する関数(ディスクキャッシュにある場合のみ)
+
+        Parameters
+        ----------
+        digest  : string
+            素材のハッシュ値
+
+        Returns
+        -------
+        rlt     : bool
+            登録済み, または読み込めた場合True
+        '''
+
+        if self.touch_(digest):
+            return True
+        if self.cache_ is None:
+            return False
+
+        asset = self.cache_.load(digest)
+        if asset is None:
+            return False
+        self.insert_(digest, asset)
+        return True
+
+    def decode_(self, data, fname, digest):
+        _, ext = os.path.splitext(fname)
+        if ext != '.gif':
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+        #VideoCaptureはファイルから読み込むため、一時的に書き出してデコードする
+        #(同じ素材を複数のスレッドが同時にデコードしても衝突しないよう、ファイル名は毎回別にする)
+        fd, fpath = tempfile.mkstemp(prefix=digest + '-', suffix=ext, dir=self.tmp_dir_)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return FrameStack.from_capture(cv2.VideoCapture(fpath))
+        finally:
+            os.remove(fpath)
+
+    def insert_(self, digest, asset):
+        with self.mutex_:
+            self.decoded_[digest] = asset
+            self.decoded_.move_to_end(digest)
+            while len(self.decoded_) > self.max_num_:
+                old, _ = self.decoded_.popitem(last=False)
+                for key in [key for key in self.prepared_ if key[0] == old]:
+                    del self.prepared_[key]
+
+    def get(self, digest):
+        '''
+        デコード済みの素材を返す関数
+
+        Parameters
+        ----------
+        digest  : string
+            素材のハッシュ値
+
+        Returns
+        -------
+        asset   : ndarray or FrameStack or None
+            デコード済みの素材(拡大前), 登録されていない場合None
+        '''
+
+        with self.mutex_:
+            return self.decoded_.get(digest)
+
+    def prepare(self, digest, obj):
+        '''
+        眼の拡大率に合わせて拡大した素材を返す関数(同じ拡大率の眼には同じ参照を返す)
+
+        Parameters
+        ----------
+        digest  : string
+            素材のハッシュ値
+
+        obj     : Eye class object
+            素材を登録する眼
+
+        Returns
+        -------
+        img     : ndarray or FrameStack or None
+            Eye.add_mode(img, prepared=True)で登録できる素材, 登録されていない場合None
+        '''
+
+        if not self.put_digest(digest):
+            return None
+
+        scale = to_scale_pair(obj.scale_)
+        key = (digest, scale)
+        with self.mutex_:
+            img = self.prepared_.get(key)
+            asset = self.decoded_.get(digest)
+        if img is not None or asset is None:
+            return img
+
+        if scale == (1.0, 1.0):
+            img = obj.prepare_mode(asset)
+        else:
+            #拡大済みの素材もディスクキャッシュに保存しておく
+            #(拡大率が近い眼で同じキーにならないよう、拡大率は丸めずに表す)
+            cache_key = '{0}-{1!r}x{2!r}'.format(digest, scale[0], scale[1])
+            img = self.cache_.load(cache_key) if self.cache_ is not None else None
+            if img is None:
+                img = obj.prepare_mode(asset)
+                if img is not None and self.cache_ is not None:
+                    self.cache_.store(cache_key, img)
+
+        with self.mutex_:
+            if digest in self.decoded_:
+                img = self.prepared_.setdefault(key, img)
+
+        return img
+
+    def touch_(self, digest):
+        #登録済みであれば最近使われたものとして並べ替える
+        with self.mutex_:
+            if digest not in self.decoded_:
+                return False
+            self.decoded_.move_to_end(digest)
+            return True
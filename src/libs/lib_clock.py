@@ -0,0 +1,133 @@
+'''
+時計 ライブラリ
+
+眼のアニメーション(Eye, EyeLid)や線形軌道(Proportion, Pow3)が参照する時刻の取得元を定義してある。
+通常は実時間の時計(WallClock)を使用するが、シミュレーション用の時計(SimClock)を渡すと
+実時間によらず時刻を進められるため、シナリオ全体を実時間より速く、毎回同じ結果で描画できる。
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import time
+
+#実時間の時計
+class WallClock:
+
+    def time(self):
+        '''
+        現在時刻を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        t       : float
+            現在時刻(time.time()と同じ)[sec]
+        '''
+
+        return time.time()
+
+#手動で時刻を進めるシミュレーション用の時計
+class SimClock:
+
+    def __init__(self, t0=0.0):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        t0      : float
+            開始時刻[sec]
+        '''
+
+        self.t_ = t0
+
+    def time(self):
+        '''
+        現在時刻を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        t       : float
+            現在時刻[sec]
+        '''
+
+        return self.t_
+
+    def set(self, t):
+        '''
+        時刻を設定する関数
+
+        Parameters
+        ----------
+        t       : float
+            設定する時刻[sec]
+
+        Returns
+        -------
+        None
+        '''
+
+        self.t_ = t
+
+    def advance(self, dt):
+        '''
+        時刻を進める関数
+
+        Parameters
+        ----------
+        dt      : float
+            進める時間[sec]
+
+        Returns
+        -------
+        t       : float
+            進めた後の時刻[sec]
+        '''
+
+        self.t_ += dt
+        return self.t_
+
+#時計を指定しなかった場合に使用する共通の時計
+default_clock_ = WallClock()
+
+def get_default_clock():
+    '''
+    共通の時計を返す関数
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    clock   : WallClock or SimClock
+        共通の時計
+    '''
+
+    return default_clock_
+
+def set_default_clock(clock):
+    '''
+    共通の時計を差し替える関数
+    (差し替えた後に生成したEye, EyeLid, Proportion, Pow3から使用される)
+
+    Parameters
+    ----------
+    clock   : WallClock or SimClock
+        time()関数を持つ時計のオブジェクト
+
+    Returns
+    -------
+    None
+    '''
+
+    global default_clock_
+    default_clock_ = clock
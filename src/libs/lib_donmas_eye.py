@@ -8,7 +8,11 @@ author  : Taiyou Komazawa
 date    : 2022/11/21
 '''
 
+from .lib_clock import *
 from .lib_linear import *
 from .lib_donmas_eye_base import *
+from .lib_frame_scheduler import *
+from .lib_frame_sink import *
+from .lib_asset_store import *
 from .lib_donmas_eye_server import *
 from .lib_donmas_eye_client import *
@@ -8,18 +8,241 @@ date    : 2022/11/21
 '''
 
 import os.path, os
-import time
 
 import cv2
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 import random
 import copy
 
+from .lib_clock import get_default_clock
+
+#gif映像のFPSが取得できなかった場合に使用するFPS
+DEFAULT_FPS = 10.0
+
+def to_scale_pair(scale):
+    '''
+    拡大率を(縦方向, 横方向)の組に変換する関数
+
+    Parameters
+    ----------
+    scale   : float or (float, float)
+        拡大率(縦横共通), または(縦方向, 横方向)の拡大率
+
+    Returns
+    -------
+    scale   : (float, float)
+        (縦方向, 横方向)の拡大率
+    '''
+
+    if np.isscalar(scale):
+        return (float(scale), float(scale))
+    return (float(scale[0]), float(scale[1]))
+
+def scale_image(img, scale, interpolation=cv2.INTER_LINEAR):
+    '''
+    画像を拡大縮小する関数
+
+    Parameters
+    ----------
+    img     : ndarray
+        入力する画像
+
+    scale   : float or (float, float)
+        拡大率(縦横共通), または(縦方向, 横方向)の拡大率
+
+    interpolation : int
+        cv2.resizeの補間方法
+
+    Returns
+    -------
+    dst     : ndarray
+        拡大縮小された画像(拡大率が1の場合は入力画像をそのまま返す)
+    '''
+
+    sy, sx = to_scale_pair(scale)
+    if sy == 1.0 and sx == 1.0:
+        return img
+
+    h, w = img.shape[:2]
+    dsize = (max(1, int(round(w*sx))), max(1, int(round(h*sy))))
+    return cv2.resize(img, dsize, interpolation=interpolation)
+
+def to_frame_stamps(stamps, fps):
+    '''
+    読み込んだ各フレームの時刻を、再生に使う時刻と1周分の再生時間に変換する関数
+
+    Parameters
+    ----------
+    stamps  : [float, ...]
+        cv2.CAP_PROP_POS_MSECから得た各フレームの時刻[sec]
+
+    fps     : float
+        gif映像のFPS(取得できなかった場合は0以下)
+
+    Returns
+    -------
+    stamps  : ndarray
+        各フレームの表示開始時刻[sec]
+
+    duration: float
+        映像1周分の再生時間[sec]
+    '''
+
+    if not fps > 0:
+        fps = DEFAULT_FPS
+
+    #フレームの時刻が取得できない(単調増加でない)場合はFPSから等間隔に割り当てる
+    stamps = np.array(stamps, dtype=np.float64)
+    if stamps[0] != 0.0 or np.any(np.diff(stamps) <= 0):
+        stamps = np.arange(len(stamps)) / fps
+
+    return stamps, stamps[-1] + 1.0/fps
+
+#デコード済みのgif映像(フレーム列)を保持するクラス
+class FrameStack:
+
+    def __init__(self, frames, stamps, duration):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        frames      : ndarray
+            フレーム列(フレーム数, 高さ, 幅, 3)
+
+        stamps      : ndarray
+            各フレームの表示開始時刻のリスト[sec]
+
+        duration    : float
+            映像1周分の再生時間[sec]
+        '''
+
+        self.frames = np.ascontiguousarray(frames)
+        self.stamps = np.asarray(stamps, dtype=np.float64)
+        self.duration = duration
+
+        #複数の眼で共有するため読み取り専用にする
+        self.frames.flags.writeable = False
+
+        self.shape = self.frames.shape[1:3]
+
+    @classmethod
+    def from_capture(cls, cap):
+        '''
+        cv2.VideoCaptureから全フレームをデコードしてFrameStackを生成する関数
+
+        Parameters
+        ----------
+        cap     : cv2.VideoCapture
+            gif映像
+
+        Returns
+        -------
+        stack   : FrameStack or None
+            デコードされたフレーム列, 1フレームも読めなかった場合None
+        '''
+
+        fps = cap.get(cv2.CAP_PROP_FPS)
+
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        frames = []
+        stamps = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+            stamps.append(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+        cap.release()
+
+        if len(frames) == 0:
+            return None
+
+        stamps, duration = to_frame_stamps(stamps, fps)
+        return cls(np.stack(frames), stamps, duration)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def scaled(self, scale):
+        '''
+        全フレームを拡大縮小したFrameStackを返す関数
+
+        Parameters
+        ----------
+        scale   : float or (float, float)
+            拡大率(縦横共通), または(縦方向, 横方向)の拡大率
+
+        Returns
+        -------
+        stack   : FrameStack
+            拡大縮小されたフレーム列(拡大率が1の場合は自身を返す)
+        '''
+
+        sy, sx = to_scale_pair(scale)
+        if sy == 1.0 and sx == 1.0:
+            return self
+
+        frames = np.stack([scale_image(frame, scale) for frame in self.frames])
+        return FrameStack(frames, self.stamps, self.duration)
+
+    def index_at(self, t):
+        '''
+        経過時間から表示するフレーム番号を返す関数(ループ再生)
+
+        Parameters
+        ----------
+        t       : float
+            再生開始からの経過時間[sec]
+
+        Returns
+        -------
+        idx     : int
+            フレーム番号
+        '''
+
+        return int(np.searchsorted(self.stamps, t % self.duration, side='right')) - 1
+
+    def indices_at(self, ts):
+        '''
+        経過時間の配列から表示するフレーム番号の配列を返す関数(ループ再生)
+
+        Parameters
+        ----------
+        ts      : ndarray
+            再生開始からの経過時間の配列[sec]
+
+        Returns
+        -------
+        idxs    : ndarray
+            フレーム番号の配列
+        '''
+
+        return np.searchsorted(self.stamps, np.mod(ts, self.duration), side='right') - 1
+
+    def frame_at(self, t):
+        '''
+        経過時間に対応するフレームを返す関数(ループ再生)
+
+        Parameters
+        ----------
+        t       : float
+            再生開始からの経過時間[sec]
+
+        Returns
+        -------
+        frame   : ndarray
+            フレーム画像
+        '''
+
+        return self.frames[self.index_at(t)]
+
 #眼(瞳)のアニメーションを定義するクラス
 class Eye:
 
-    def __init__(self, bg, pupil_paths, min_range=[0,0], max_range=[0,0], th=0.0):
+    def __init__(self, bg, pupil_paths, min_range=[0,0], max_range=[0,0], th=0.0, scale=1.0, clock=None, rng=None, assets=None):
         '''
         クラスコンストラクタ
 
@@ -39,23 +262,47 @@ class Eye:
 
         th  : float
             眼の固定角度(度)
+
+        scale   : float or (float, float)
+            出力画像の拡大率(縦横共通, または(縦方向, 横方向))
+            瞳の画像と座標の範囲は読み込み時にこの拡大率で拡大され、出力解像度のまま描写される
+
+        clock   : WallClock or SimClock
+            時刻の取得元(Noneの場合は共通の時計)
+
+        rng     : random.Random
+            瞳の振れに使う乱数生成器(Noneの場合はrandomモジュール)
+
+        assets  : AssetStore
+            瞳の画像を読み込む素材ストア(Noneの場合はファイルから直接デコードする)
+            ディスクキャッシュを持つ素材ストアであれば、2回目以降の起動ではデコード・拡大済みの画像を読み込む
         '''
 
+        self.clock_ = clock if clock is not None else get_default_clock()
+        self.rng_ = rng if rng is not None else random
+
         self.bg_ = bg
+        self.scale_ = to_scale_pair(scale)
+
+        #描写結果に影響する状態(位置, 振れ, モード, gifのフレーム)が変化するたびに増える世代番号
+        self.gen_ = 0
 
         self.pupils_ = []
         self.pupils_gif_mode_ = []
         for pupil_path in pupil_paths:
             _, ext = os.path.splitext(pupil_path)
-            if ext == '.gif':
+            if assets is not None:
+                digest = assets.load_file(pupil_path)
+                self.add_mode(assets.prepare(digest, self) if digest is not None else None, prepared=True)
+            elif ext == '.gif':
                 self.add_mode(cv2.VideoCapture(pupil_path))
             else:
                 self.add_mode(cv2.imread(pupil_path, cv2.IMREAD_COLOR))
 
         self.bg_r_ = self.bg_.shape[:2]
 
-        self.min_r_ = min_range
-        self.max_r_ = max_range
+        self.min_r_ = [min_range[0]*self.scale_[0], min_range[1]*self.scale_[1]]
+        self.max_r_ = [max_range[0]*self.scale_[0], max_range[1]*self.scale_[1]]
 
         self.p_pos_ = (0.0, 0.0)
         self.p_noise_ = (0, 0)
@@ -64,18 +311,71 @@ class Eye:
         self.sin_th = np.sin(th/180*np.pi)
 
         self.change_mode(0)
-        self.last_n_tim_ = time.time()
+        self.last_n_tim_ = self.clock_.time()
+
+    def clone(self, rng=None):
+        '''
+        デコード済みの瞳の画像を共有した眼を複製する関数
+        (複数の顔を描画する場合に同じ素材を再度読み込まないために使用する)
+
+        Parameters
+        ----------
+        rng     : random.Random
+            複製した眼の瞳の振れに使う乱数生成器(Noneの場合は複製元と共通)
+
+        Returns
+        -------
+        obj     : Eye
+            瞳の画像を共有し、位置やモードなどの状態は独立した眼
+        '''
+
+        obj = copy.copy(self)
+        obj.pupils_ = list(self.pupils_)
+        obj.pupils_gif_mode_ = list(self.pupils_gif_mode_)
+        if rng is not None:
+            obj.rng_ = rng
+
+        return obj
+
+    def prepare_mode(self, img):
+        '''
+        瞳の画像を描写に使える形(デコード・拡大済み)に変換する関数
+
+        Parameters
+        ----------
+        img     :   ndarray or FrameStack or cv2.VideoCapture
+            瞳の画像(またはgif映像)
+            cv2.VideoCaptureはここで全フレームをデコードしてFrameStackに変換する
+
+        Returns
+        -------
+        img     :   ndarray or FrameStack or None
+            拡大率に合わせて拡大された瞳の画像, 変換できなかった場合None
+        '''
+
+        if type(img) is cv2.VideoCapture:
+            img = FrameStack.from_capture(img)
+
+        if type(img) is FrameStack:
+            return img.scaled(self.scale_)
+        elif type(img) is np.ndarray:
+            return scale_image(img, self.scale_)
+        else:
+            return None
 
-    def add_mode(self, img, mode_id=-1):
+    def add_mode(self, img, mode_id=-1, prepared=False):
         '''
         瞳のタイプを追加(すでにある場合は上書き)する関数
 
         Parameters
         ----------
-        img     :   ndarray or cv2.VideoCapture
+        img     :   ndarray or FrameStack or cv2.VideoCapture
             瞳の画像(またはgif映像)
+            cv2.VideoCaptureはここで全フレームをデコードしてFrameStackとして保持する
         mode_id :   int
             追加する瞳の表情モード(負値で最後尾に追加)
+        prepared:   bool
+            imgがprepare_mode()で変換済みかどうか(Trueなら参照をそのまま登録する)
 
         Returns
         -------
@@ -85,8 +385,11 @@ class Eye:
 
         rlt = 0
 
+        if not prepared:
+            img = self.prepare_mode(img)
+
         if mode_id >= self.numof_mode() or mode_id < 0:
-            if type(img) is cv2.VideoCapture:
+            if type(img) is FrameStack:
                 self.pupils_.append(img)
                 self.pupils_gif_mode_.append(True)
                 rlt = self.numof_mode() - 1
@@ -97,7 +400,7 @@ class Eye:
             else:
                 rlt = -1
         elif mode_id < self.numof_mode():
-            if type(img) is cv2.VideoCapture:
+            if type(img) is FrameStack:
                 self.pupils_[mode_id] = img
                 self.pupils_gif_mode_[mode_id] = True
                 rlt = mode_id
@@ -108,6 +411,9 @@ class Eye:
             else:
                 rlt = -1
 
+        if rlt >= 0:
+            self.gen_ += 1
+
         return rlt
 
     def change_mode(self, mode_id):
@@ -125,24 +431,23 @@ class Eye:
         '''
 
         if mode_id < len(self.pupils_):
+            self.mode_id_ = mode_id
             self.pupil_ = self.pupils_[mode_id]
             self.pupil_gif_mode = self.pupils_gif_mode_[mode_id]
 
             if self.pupil_gif_mode:
-                self.pupil_r_ = [int(self.pupil_.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                                int(self.pupil_.get(cv2.CAP_PROP_FRAME_WIDTH))]
-                self.pupil_.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                self.last_f_tim_ = time.time()
-            else:
-                self.pupil_r_ = self.pupil_.shape[:2]
-
-            self.min_mr_ = [self.min_r_[0], self.min_r_[1]]
-            self.min_mr_[0] += self.pupil_r_[0] / 2
-            self.min_mr_[1] += self.pupil_r_[1] / 2
-            self.max_mr_ = [self.max_r_[0], self.max_r_[1]]
-            self.max_mr_[0] -= self.pupil_r_[0] / 2
-            self.max_mr_[1] -= self.pupil_r_[1] / 2
+                self.last_f_tim_ = self.clock_.time()
+            self.gif_idx_ = 0
+            self.pupil_r_, self.min_mr_, self.max_mr_ = self.mode_range_(self.pupil_)
             self.set_pos(0.5, 0.5)
+            self.gen_ += 1
+
+    def mode_range_(self, pupil):
+        #瞳の大きさと、瞳の中心が動ける範囲(最小, 最大)を求める
+        pupil_r = pupil.shape[:2]
+        min_mr = [self.min_r_[0] + pupil_r[0] / 2, self.min_r_[1] + pupil_r[1] / 2]
+        max_mr = [self.max_r_[0] - pupil_r[0] / 2, self.max_r_[1] - pupil_r[1] / 2]
+        return pupil_r, min_mr, max_mr
 
     def numof_mode(self):
         '''
@@ -176,10 +481,17 @@ class Eye:
         None
         '''
 
+        p_pos = self.rotate_pos_(y, x)
+        if p_pos != self.p_pos_:
+            self.p_pos_ = p_pos
+            self.gen_ += 1
+
+    def rotate_pos_(self, y, x):
+        #眼の固定角度だけ中心(0.5, 0.5)まわりに回転した座標(x, y)を返す(配列でも計算できる)
         rot_x = (x-0.5)*self.cos_th - (y-0.5)*self.sin_th + 0.5
         rot_y = (x-0.5)*self.sin_th + (y-0.5)*self.cos_th + 0.5
 
-        self.p_pos_ = (rot_x, rot_y)
+        return (rot_x, rot_y)
 
     def spin_once(self, src, noise_range=0.001, noise_sec=1.0):
         '''
@@ -201,13 +513,103 @@ class Eye:
         '''
 
         dst = copy.copy(src)
+        self.draw(dst, noise_range, noise_sec)
+
+        return dst
+
+    def draw(self, dst, noise_range=0.001, noise_sec=1.0):
+        '''
+        瞳を画像に直接描写する関数
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像(この画像に直接書き込まれる)
+        noise_range : float
+            眼の振れ幅
+        noise_sec : float
+            瞳の座標振れ間隔
+
+        Returns
+        -------
+        rect    : (int, int, int, int)
+            瞳を描写した矩形(上端y, 下端y, 左端x, 右端x)
+        '''
+
+        self.update(noise_range, noise_sec)
+        return self.blit(dst)
+
+    def update(self, noise_range=0.001, noise_sec=1.0):
+        '''
+        時刻に応じて瞳の振れとgifのフレームを更新する関数
+
+        Parameters
+        ----------
+        noise_range : float
+            眼の振れ幅
+        noise_sec : float
+            瞳の座標振れ間隔
 
-        if((time.time()-self.last_n_tim_) > noise_sec):
+        Returns
+        -------
+        gen     : int
+            世代番号(描写結果に影響する状態が変化するたびに増える)
+        '''
+
+        if((self.clock_.time()-self.last_n_tim_) > noise_sec):
             self.p_noise_ = [
-                random.uniform(-noise_range, noise_range),
-                random.uniform(-noise_range, noise_range)
+                self.rng_.uniform(-noise_range, noise_range),
+                self.rng_.uniform(-noise_range, noise_range)
             ]
-            self.last_n_tim_ = time.time()
+            self.last_n_tim_ = self.clock_.time()
+            self.gen_ += 1
+
+        if self.pupil_gif_mode:
+            #デコード済みのフレーム列から経過時間に対応するフレームを選ぶ
+            gif_idx = self.pupil_.index_at(self.clock_.time() - self.last_f_tim_)
+            if gif_idx != self.gif_idx_:
+                self.gif_idx_ = gif_idx
+                self.gen_ += 1
+
+        return self.gen_
+
+    def blit(self, dst):
+        '''
+        現在の状態の瞳を画像に直接描写する関数(時刻による状態の更新は行わない)
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像(この画像に直接書き込まれる)
+
+        Returns
+        -------
+        rect    : (int, int, int, int)
+            瞳を描写した矩形(上端y, 下端y, 左端x, 右端x)
+        '''
+
+        rect = self.get_rect()
+
+        if self.pupil_gif_mode:
+            dst[rect[0]:rect[1], rect[2]:rect[3]] = self.pupil_.frames[self.gif_idx_]
+        else:
+            dst[rect[0]:rect[1], rect[2]:rect[3]] = self.pupil_
+
+        return rect
+
+    def get_rect(self):
+        '''
+        現在の瞳の位置から瞳を描写する矩形を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        rect    : (int, int, int, int)
+            瞳を描写する矩形(上端y, 下端y, 左端x, 右端x)
+        '''
 
         p_pos_h = np.clip(self.p_pos_[1]+self.p_noise_[1], 0.0, 1.0)
         p_pos_w = np.clip(self.p_pos_[0]+self.p_noise_[0], 0.0, 1.0)
@@ -217,40 +619,114 @@ class Eye:
             (self.max_mr_[1]-self.min_mr_[1])*p_pos_w+self.min_mr_[1]-self.pupil_r_[1]/2
         )
 
-        p_pxh = [
+        return (
             int(px_org[0]),
-            int(px_org[0])+self.pupil_r_[0]
-        ]
-        p_pxw = [
+            int(px_org[0])+self.pupil_r_[0],
             int(px_org[1]),
             int(px_org[1])+self.pupil_r_[1]
-        ]
+        )
 
-        if self.pupil_gif_mode:
+    def render_batch(self, src, pos, modes=None, times=None, noises=None):
+        '''
+        複数フレーム分の瞳をまとめて描写する関数
+
+        Parameters
+        ----------
+        src     : ndarray
+            入力する画像(全フレーム共通の背景)
+        pos     : ndarray
+            各フレームの瞳の位置(フレーム数, 2)。各行はset_pos()と同じ(y, x)
+        modes, times, noises :
+            draw_batch()を参照
+
+        Returns
+        -------
+        dst     : ndarray
+            出力画像の配列(フレーム数, 高さ, 幅, 3)
+        '''
 
-            T = 1.0/self.pupil_.get(cv2.CAP_PROP_FPS)
-            img = 0
+        dst = np.empty((len(pos),) + src.shape, dtype=src.dtype)
+        dst[...] = src
+        self.draw_batch(dst, pos, modes, times, noises)
 
-            if (time.time() - self.last_f_tim_) >= T:
-                if self.pupil_.get(cv2.CAP_PROP_POS_FRAMES) >= self.pupil_.get(cv2.CAP_PROP_FRAME_COUNT):
-                    self.pupil_.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return dst
 
-                ret, img = self.pupil_.read()
-                self.last_f_tim_ = time.time()
-            else:
-                ret, img = self.pupil_.retrieve()
+    def draw_batch(self, dst, pos, modes=None, times=None, noises=None):
+        '''
+        複数フレーム分の瞳を画像の配列に直接描写する関数
+        (眼の状態(位置, モード, 振れ)は変更しない)
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像の配列(フレーム数, 高さ, 幅, 3)(この配列に直接書き込まれる)
+        pos     : ndarray
+            各フレームの瞳の位置(フレーム数, 2)。各行はset_pos()と同じ(y, x)
+        modes   : ndarray
+            各フレームの瞳の表情モード(Noneの場合は現在のモード)
+        times   : ndarray
+            各フレームのgifの再生開始からの経過時間[sec]
+            (Noneの場合は全フレームで現在の経過時間。pngの瞳では使用しない)
+        noises  : ndarray
+            各フレームの瞳の座標の振れ(フレーム数, 2)(Noneの場合は全フレームで現在の振れ)
+
+        Returns
+        -------
+        rects   : ndarray
+            各フレームの瞳を描写した矩形(フレーム数, 4)(上端y, 下端y, 左端x, 右端x)
+        '''
 
-            if ret:
-                dst[p_pxh[0]:p_pxh[1], p_pxw[0]:p_pxw[1]] = img
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+        num = len(pos)
+
+        if modes is None:
+            modes = np.full(num, self.mode_id_)
         else:
-            dst[p_pxh[0]:p_pxh[1], p_pxw[0]:p_pxw[1]] = self.pupil_
+            modes = np.broadcast_to(np.asarray(modes, dtype=np.intp), (num,))
+        if np.any((modes < 0) | (modes >= self.numof_mode())):
+            raise ValueError("Unknown mode in {0}".format(np.unique(modes)))
 
-        return dst
+        if times is None:
+            t = self.clock_.time() - self.last_f_tim_ if self.pupil_gif_mode else 0.0
+            times = np.full(num, t)
+        else:
+            times = np.broadcast_to(np.asarray(times, dtype=np.float64), (num,))
+
+        if noises is None:
+            noises = np.broadcast_to(np.asarray(self.p_noise_, dtype=np.float64), (num, 2))
+        else:
+            noises = np.broadcast_to(np.asarray(noises, dtype=np.float64), (num, 2))
+
+        #set_pos()とget_rect()の計算を全フレームまとめて行う
+        rot_x, rot_y = self.rotate_pos_(pos[:, 0], pos[:, 1])
+        p_pos_h = np.clip(rot_y + noises[:, 1], 0.0, 1.0)
+        p_pos_w = np.clip(rot_x + noises[:, 0], 0.0, 1.0)
+
+        rects = np.empty((num, 4), dtype=np.intp)
+        for mode_id in np.unique(modes):
+            sel = np.flatnonzero(modes == mode_id)
+            pupil = self.pupils_[mode_id]
+            pupil_r, min_mr, max_mr = self.mode_range_(pupil)
+
+            org_y = np.trunc((max_mr[0]-min_mr[0])*p_pos_h[sel]+min_mr[0]-pupil_r[0]/2).astype(np.intp)
+            org_x = np.trunc((max_mr[1]-min_mr[1])*p_pos_w[sel]+min_mr[1]-pupil_r[1]/2).astype(np.intp)
+            rects[sel] = np.stack((org_y, org_y+pupil_r[0], org_x, org_x+pupil_r[1]), axis=1)
+
+            #瞳の大きさの窓を並べたビューを使い、同じモードのフレームの矩形へ一度に書き込む
+            #(ビューの各窓は(チャンネル, 高さ, 幅)の順に並ぶ)
+            windows = sliding_window_view(dst, pupil_r, axis=(1, 2), writeable=True)
+            if self.pupils_gif_mode_[mode_id]:
+                img = pupil.frames[pupil.indices_at(times[sel])].transpose(0, 3, 1, 2)
+            else:
+                img = pupil.transpose(2, 0, 1)
+            windows[sel, org_y, org_x] = img
+
+        return rects
 
 #まぶた(瞬き)のアニメーションを定義するクラス
 class EyeLid:
 
-    def __init__(self, eyelid_cap, eyelid_mask):
+    def __init__(self, eyelid_cap, eyelid_mask, scale=1.0, clock=None, rng=None):
         '''
         クラスコンストラクタ
 
@@ -261,17 +737,120 @@ class EyeLid:
 
         eyelid_mask : cv2.VideoCapture class object
             まぶたのgif映像のマスク
+
+        scale       : float or (float, float)
+            出力画像の拡大率(縦横共通, または(縦方向, 横方向))
+            まぶたとマスクの映像は読み込み時にこの拡大率で拡大される
+
+        clock       : WallClock or SimClock
+            時刻の取得元(Noneの場合は共通の時計)
+
+        rng         : random.Random
+            瞬きの間隔の散乱に使う乱数生成器(Noneの場合はrandomモジュール)
         '''
 
-        self.eyelid_ = eyelid_cap
-        self.eyelid_mask_ = eyelid_mask
-        self.last_lid_time = time.time()
+        self.clock_ = clock if clock is not None else get_default_clock()
+        self.rng_ = rng if rng is not None else random
+        self.scale_ = to_scale_pair(scale)
+        self.load_frames_(eyelid_cap, eyelid_mask)
+        self.lid_idx_ = 0
+        #描写するまぶたのフレーム番号(描写しない場合None)と、それが変化するたびに増える世代番号
+        self.shown_idx_ = None
+        self.gen_ = 0
+        self.loop_cnt = 1
+        self.last_lid_time = self.clock_.time()
 
         self.lid_sec_ = 3.0
         self.lid_loop_ = 2
         self.lid_scat_ = 7.0
 
-        self.lid_ex_sec_ = random.uniform(0, self.lid_scat_)
+        self.lid_ex_sec_ = self.rng_.uniform(0, self.lid_scat_)
+
+    def load_frames_(self, eyelid_cap, eyelid_mask):
+        #まぶたとマスクの全フレームを読み込み、まぶたに覆われる領域(マスクが0の画素)の
+        #外接矩形と、その矩形内のフレーム・マスクだけを保持しておく
+        self.lid_rects_ = []
+        self.lid_frames_ = []
+        self.lid_covers_ = []
+        stamps = []
+
+        fps = eyelid_cap.get(cv2.CAP_PROP_FPS)
+        while True:
+            ret_m, mask = eyelid_mask.read()
+            ret, frame = eyelid_cap.read()
+            if not (ret_m and ret):
+                break
+            stamps.append(eyelid_cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+
+            frame = scale_image(frame, self.scale_)
+            mask = scale_image(mask, self.scale_, cv2.INTER_NEAREST)
+
+            cover = np.any(mask == 0, axis=2)
+            rows = np.flatnonzero(cover.any(axis=1))
+            cols = np.flatnonzero(cover.any(axis=0))
+            if len(rows) == 0:
+                #まぶたが画面に掛かっていないフレーム
+                self.lid_rects_.append(None)
+                self.lid_frames_.append(None)
+                self.lid_covers_.append(None)
+                continue
+
+            rect = (int(rows[0]), int(rows[-1])+1, int(cols[0]), int(cols[-1])+1)
+            lid_frame = np.ascontiguousarray(frame[rect[0]:rect[1], rect[2]:rect[3]])
+            lid_cover = np.ascontiguousarray(cover[rect[0]:rect[1], rect[2]:rect[3], np.newaxis])
+            #複数のまぶたで共有するため読み取り専用にする
+            lid_frame.flags.writeable = False
+            lid_cover.flags.writeable = False
+            self.lid_rects_.append(rect)
+            self.lid_frames_.append(lid_frame)
+            self.lid_covers_.append(lid_cover)
+
+        eyelid_cap.release()
+        eyelid_mask.release()
+
+        #瞬き1回分(まぶたを1回閉じて開く)の各フレームの表示開始時刻と再生時間
+        if len(stamps) == 0:
+            self.lid_stamps_, self.lid_duration_ = np.zeros(0), 1.0/DEFAULT_FPS
+        else:
+            self.lid_stamps_, self.lid_duration_ = to_frame_stamps(stamps, fps)
+
+    def clone(self, rng=None):
+        '''
+        デコード済みのまぶたの映像を共有したまぶたを複製する関数
+        (複数の顔を描画する場合に同じ素材を再度読み込まないために使用する)
+
+        Parameters
+        ----------
+        rng     : random.Random
+            複製したまぶたの瞬きの間隔の散乱に使う乱数生成器(Noneの場合は複製元と共通)
+
+        Returns
+        -------
+        obj     : EyeLid
+            まぶたの映像を共有し、瞬きの周期などの状態は独立したまぶた
+        '''
+
+        obj = copy.copy(self)
+        if rng is not None:
+            obj.rng_ = rng
+
+        return obj
+
+    def numof_frame(self):
+        '''
+        まぶたの映像のフレーム数を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        len     : int
+            1回閉じて開くまでのフレーム数
+        '''
+
+        return len(self.lid_rects_)
 
     def set_interval(self, sec, loop=2, scat_sec=6.0):
         '''
@@ -297,8 +876,8 @@ class EyeLid:
         self.lid_loop_ = loop
         self.lid_scat_ = scat_sec
         self.loop_cnt = 1
-        self.last_lid_time = time.time()
-        self.lid_ex_sec_ = random.uniform(0, self.lid_scat_)
+        self.last_lid_time = self.clock_.time()
+        self.lid_ex_sec_ = self.rng_.uniform(0, self.lid_scat_)
 
     def spin_once(self, src):
         '''
@@ -307,7 +886,7 @@ class EyeLid:
         Parameters
         ----------
         src     : ndarray
-            入力する画像
+            入力する画像(入力画像は変更しない。直接書き込む場合はdraw()を使う)
 
         Returns
         -------
@@ -315,27 +894,135 @@ class EyeLid:
             出力画像。瞬きの待ち時間であれば入力画像がそのまま返却される
         '''
 
-        if self.lid_loop_ <= 0:
-            self.last_lid_time = time.time()
+        self.update()
+        if self.shown_idx_ is None:
             return src
 
-        if (time.time() - self.last_lid_time) > (self.lid_sec_+self.lid_ex_sec_):
-            ret_m, mask = self.eyelid_mask_.read()
-            ret, frame = self.eyelid_.read()
+        dst = copy.copy(src)
+        self.blit(dst)
+        return dst
 
-            if ret_m and ret:
-                masked_src = cv2.bitwise_and(src, mask)
-                return cv2.addWeighted(masked_src, 1, frame, 1, 0)
-            else:
-                self.eyelid_mask_.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                self.eyelid_.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                if self.loop_cnt < self.lid_loop_:
-                    self.loop_cnt += 1
-                else:
-                    self.last_lid_time = time.time()
-                    self.loop_cnt = random.randint(1, self.lid_loop_)
-                    self.lid_ex_sec_ = random.uniform(0, self.lid_scat_)
-                return src
+    def draw(self, dst):
+        '''
+        周期を測り瞬きを画像に直接描写する関数
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像(この画像に直接書き込まれる)
+
+        Returns
+        -------
+        rect    : (int, int, int, int) or None
+            まぶたを描写した矩形(上端y, 下端y, 左端x, 右端x)。描写しなかった場合None
+        '''
+
+        self.update()
+        return self.blit(dst)
+
+    def update(self):
+        '''
+        周期を測り、現在の時刻に表示するまぶたのフレームを選ぶ関数
+        (描画が遅れた場合は途中のフレームを飛ばし、瞬きの速さは描画の速さによらず一定になる)
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        gen     : int
+            世代番号(描写するまぶたのフレームが変化するたびに増える)
+        '''
+
+        shown_idx = None
+        now = self.clock_.time()
+
+        if self.lid_loop_ <= 0 or len(self.lid_rects_) == 0:
+            self.last_lid_time = now
         else:
-            return src
+            while True:
+                #待ち時間が過ぎた時刻から、loop_cnt〜lid_loop_回分まぶたを閉じて開く
+                blink_start = self.last_lid_time + self.lid_sec_ + self.lid_ex_sec_
+                t = now - blink_start
+                if t <= 0:
+                    break
+
+                blink_len = (self.lid_loop_ - self.loop_cnt + 1)*self.lid_duration_
+                if t < blink_len:
+                    self.lid_idx_ = int(np.searchsorted(self.lid_stamps_, t % self.lid_duration_, side='right')) - 1
+                    shown_idx = self.lid_idx_
+                    break
+
+                #瞬きが終わった時刻を基準に次の瞬きまでの時間を決める
+                #(次の待ち時間の最大値よりも長く止まっていた場合は、飛ばした瞬きを再現せず現在から待ち直す)
+                self.lid_idx_ = 0
+                self.last_lid_time = blink_start + blink_len
+                if now - self.last_lid_time > self.lid_sec_ + self.lid_scat_:
+                    self.last_lid_time = now
+                self.loop_cnt = self.rng_.randint(1, self.lid_loop_)
+                self.lid_ex_sec_ = self.rng_.uniform(0, self.lid_scat_)
+
+        if shown_idx != self.shown_idx_:
+            self.shown_idx_ = shown_idx
+            self.gen_ += 1
+
+        return self.gen_
+
+    def blit(self, dst):
+        '''
+        現在のまぶたのフレームを画像に直接描写する関数(周期の更新は行わない)
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像(この画像に直接書き込まれる)
+
+        Returns
+        -------
+        rect    : (int, int, int, int) or None
+            まぶたを描写した矩形(上端y, 下端y, 左端x, 右端x)。描写しなかった場合None
+        '''
+
+        if self.shown_idx_ is None:
+            return None
+
+        rect = self.lid_rects_[self.shown_idx_]
+        if rect is not None:
+            #まぶたに覆われる矩形内だけをマスク付きでコピーする
+            np.copyto(dst[rect[0]:rect[1], rect[2]:rect[3]],
+                      self.lid_frames_[self.shown_idx_],
+                      where=self.lid_covers_[self.shown_idx_])
+        return rect
+
+    def draw_batch(self, dst, lid_idxs):
+        '''
+        複数フレーム分のまぶたを画像の配列に直接描写する関数
+        (瞬きの周期の状態は変更しない)
+
+        Parameters
+        ----------
+        dst     : ndarray
+            描写先の画像の配列(フレーム数, 高さ, 幅, 3)(この配列に直接書き込まれる)
+
+        lid_idxs: ndarray
+            各フレームで描写するまぶたのフレーム番号(負値または範囲外の場合は描写しない)
+
+        Returns
+        -------
+        None
+        '''
 
+        lid_idxs = np.asarray(lid_idxs, dtype=np.intp)
+        for lid_idx in np.unique(lid_idxs):
+            if lid_idx < 0 or lid_idx >= len(self.lid_rects_):
+                continue
+            rect = self.lid_rects_[lid_idx]
+            if rect is None:
+                continue
+
+            #同じまぶたのフレームを描写する画像をまとめてマスク付きでコピーする
+            sel = np.flatnonzero(lid_idxs == lid_idx)
+            roi = dst[sel, rect[0]:rect[1], rect[2]:rect[3]]
+            np.copyto(roi, self.lid_frames_[lid_idx], where=self.lid_covers_[lid_idx])
+            dst[sel, rect[0]:rect[1], rect[2]:rect[3]] = roi
@@ -2,6 +2,9 @@
 ドンマス-アイ クライアント ライブラリ
 
 ドンマス-アイのクライアント動作に必要なクラスを定義してある。
+サーバーは受信したコマンドごとに、そのデータIDを付けた応答を順番に返すため、
+応答を待たずに複数のコマンドを送信し(パイプライン)、後から届いた応答のデータIDで
+それ以前のコマンドをまとめて完了とみなすことができる。
 
 author  : Taiyou Komazawa
 date    : 2022/11/21
@@ -13,7 +16,10 @@ import time
 import numpy as np
 
 import socket
-import struct
+import hashlib
+import asyncio
+import threading
+from collections import deque
 
 from .lib_tcp_protocol import *
 from .donmas_eye_server_keys import HeaderKey as Key
@@ -21,7 +27,7 @@ from .donmas_eye_server_keys import HeaderKey as Key
 #眼の動作を制御するサーバーのクライアント側で実行できる動作を定義するクラス
 class EyesControlClient:
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, face_id=0, chunk_sz=64*1024, max_in_flight=1, udp_port=None):
         '''
         クラスコンストラクタ
 
@@ -32,27 +38,68 @@ class EyesControlClient:
 
         port    : int
             接続するポート
+
+        face_id : int
+            制御する顔のID(サーバーが複数の顔を描画している場合)
+
+        chunk_sz: int
+            画像を分割して送信する場合の1回あたりの大きさ[bytes]
+
+        max_in_flight   : int
+            応答を待たずに送信できるコマンドの数
+            (1の場合はコマンドごとに応答を待つ。2以上の場合は上限に達するまで応答を待たずに送信し、
+             get_response()は受信済みの最新の応答を返す。flush()で全ての応答を待てる)
+
+        udp_port        : int
+            サーバーが瞳の座標をUDPで受け付けるポート
+            (指定した場合、set_pos()はUDPで送信して応答を待たない。Noneの場合は他のコマンドと同じくTCPで送信する)
         '''
 
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client.connect((ip, port))
 
+        #瞳の座標を送るUDPのソケットと、そのデータグラムの通し番号
+        self.udp_ = None
+        self.udp_seq_ = 0
+        if udp_port is not None:
+            self.udp_ = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_.connect((ip, udp_port))
+
         self.data_id_ = 0
+        self.face_id_ = face_id
+        self.chunk_sz_ = chunk_sz
+        self.max_in_flight_ = max(1, max_in_flight)
 
-        self.data_ = b''
-        self.payload_sz_ = struct.calcsize('>L')
+        #応答の受信バッファ(応答ごとに確保せずに使い回す)
+        self.reader_ = FrameReader(self.client)
+        #応答を待っているコマンドのデータID(送信順)
+        self.in_flight_ = deque()
+        #複数のスレッドから送信された場合に、送信と応答の受信の順番を保つための排他用
+        self.mutex_ = threading.Lock()
 
         self.resp_packets_ = {
             Key().data_id : -1,
             Key().mode_num : 0
         }
 
+        #接続直後はpickle形式で対応バージョンを伝え、サーバーが対応していればバイナリ形式に切り替える
+        #(古いサーバーは未知のキーを無視するため、そのままpickle形式で通信する)
+        self.binary_ = False
+        self.send_({Key().proto_ver : WIRE_VERSION}, sync=True)
+        self.binary_ = self.resp_packets_.get(Key().proto_ver, 1) >= WIRE_VERSION
+
     def __del__(self):
         '''
         クラスデストラクタ
         '''
-        self.client.shutdown(socket.SHUT_RDWR)
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            #サーバー側から既に切断されている
+            pass
         self.client.close()
+        if self.udp_ is not None:
+            self.udp_.close()
 
     def set_pos(self, x, y):
         '''
@@ -72,6 +119,15 @@ class EyesControlClient:
             書き込んだバイト数 [bytes]
         '''
 
+        if self.udp_ is not None:
+            #UDPで送信し、応答は待たない(古いデータグラムはサーバーが通し番号で破棄する)
+            self.udp_seq_ = (self.udp_seq_ + 1) & 0xffffffff
+            try:
+                return self.udp_.send(pack_datagram(DGRAM_POS, self.face_id_, self.udp_seq_, x, y))
+            except OSError:
+                #サーバーのUDPのポートが閉じている場合など(次の座標で送り直す)
+                return 0
+
         packets = {
             Key().x_pos : x,
             Key().y_pos : y
@@ -132,6 +188,7 @@ class EyesControlClient:
     def add_mode(self, right_path, left_path=None, mode_id=-1):
         '''
         瞳の画像(またはgif画像)をサーバーに送信する関数
+        (サーバーが既に同じ内容の画像を持っている場合は画像本体を送信しない)
 
         Parameters
         ----------
@@ -150,50 +207,16 @@ class EyesControlClient:
             書き込んだバイト数 [bytes]
         '''
 
-        if left_path is None or (right_path == left_path):
-            _, f_name = os.path.split(right_path)
-
-            f = open(right_path, 'rb')
-
-            f_data = {
-                Key().mode_fname    : f_name,
-                Key().mode_bin      : f.read(),
-            }
-            packets = {
-                Key().rl_mode_img   : f_data,
-                Key().mode_id       : mode_id
-            }
-
-            f.close()
-        else:
-            _, rf_name = os.path.split(right_path)
-            _, lf_name = os.path.split(left_path)
-
-            rf = open(right_path, 'rb')
-            lf = open(left_path, 'rb')
-
-            rf_data = {
-                Key().mode_fname    : rf_name,
-                Key().mode_bin      : rf.read(),
-            }
-            lf_data = {
-                Key().mode_fname    : lf_name,
-                Key().mode_bin      : lf.read(),
-            }
-            packets = {
-                Key().right_mode_img: rf_data,
-                Key().left_mode_img : lf_data,
-                Key().mode_id       : mode_id
-            }
-
-            rf.close()
-            lf.close()
+        if left_path is None:
+            left_path = right_path
 
-        return self.send_(packets)
+        assets = self.upload_assets_([right_path, left_path])
+        return self.send_mode_(assets[right_path], assets[left_path], mode_id)
 
     def add_modes(self, right_paths, left_paths, head_m_id=-1):
         '''
         瞳の画像(またはgif画像)リストをサーバーに送信する関数
+        (サーバーが既に同じ内容の画像を持っている場合は画像本体を送信しない)
 
         Parameters
         ----------
@@ -211,15 +234,13 @@ class EyesControlClient:
         None
         '''
 
-        if head_m_id <= -1:
-            for (r, l) in zip(right_paths, left_paths):
-                self.add_mode(r, l)
-        else:
-            i = head_m_id
-            for (r, l) in zip(right_paths, left_paths):
-                self.add_mode(r, l, i)
-                i += 1
+        #全ての画像のハッシュ値をまとめて問い合わせ、サーバーに無い画像だけ先に送信する
+        assets = self.upload_assets_(list(right_paths) + list(left_paths))
 
+        i = head_m_id
+        for (r, l) in zip(right_paths, left_paths):
+            self.send_mode_(assets[r], assets[l], i if head_m_id > -1 else -1)
+            i += 1
 
     def numof_mode(self, sync=True):
         '''
@@ -228,7 +249,7 @@ class EyesControlClient:
         Parameters
         ----------
         sync    : bool
-            サーバーからのレスポンスを更新するかどうか
+            送信済みの全てのコマンドの応答を待ってから返すかどうか
 
         Returns
         -------
@@ -237,12 +258,37 @@ class EyesControlClient:
         '''
 
         if sync:
-            self.update_response_()
+            self.flush()
         return self.resp_packets_[Key().mode_num]
 
+    def get_stats(self):
+        '''
+        サーバーから描画の処理時間の統計情報を取得する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            stages      : 描画の段階(state, restore, right, left, eyelid, resize, display, lock-wait)ごとの
+                          処理時間の統計(count, mean, p50, p90, p99, max, hist)[sec]
+            hist-edges  : ヒストグラムの区間の境界[sec]
+            render      : 描画スレッドのフレーム周期の統計
+        '''
+
+        packets = {
+            Key().stats : True
+        }
+
+        self.send_(packets, sync=True)
+        return self.resp_packets_.get(Key().stats, {})
+
     def get_response(self):
         '''
         サーバーからレスポンスを取得する関数
+        (max_in_flightが2以上の場合は受信済みの最新の応答。全ての応答が必要な場合は先にflush()を呼ぶ)
 
         Parameters
         ----------
@@ -258,15 +304,527 @@ class EyesControlClient:
 
         return self.resp_packets_
 
+    def flush(self):
+        '''
+        送信済みの全てのコマンドの応答を待つ関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        data_id : int
+            応答を受信した最新のデータID
+        '''
+
+        with self.mutex_:
+            while len(self.in_flight_) > 0 and self.update_response_():
+                pass
+        return self.resp_packets_[Key().data_id]
+
+    def numof_in_flight(self):
+        '''
+        応答を待っているコマンドの数を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        num     : int
+            応答を待っているコマンドの数
+        '''
+
+        return len(self.in_flight_)
+
     def update_response_(self):
-        r_dict = receive(self.client)
+        #応答を1つ受信し、そのデータID以前のコマンドを完了とする(接続が閉じられた場合はFalseを返す)
+        r_dict, _ = self.reader_.receive_message()
+        if r_dict is None:
+            self.in_flight_.clear()
+            return False
         if len(r_dict.keys()) > 0:
             self.resp_packets_[Key().data_id] = r_dict[Key().data_id]
             self.resp_packets_[Key().mode_num] = r_dict[Key().mode_num]
+            if Key().stats in r_dict:
+                self.resp_packets_[Key().stats] = r_dict[Key().stats]
+            if Key().proto_ver in r_dict:
+                self.resp_packets_[Key().proto_ver] = r_dict[Key().proto_ver]
+            #画像の問い合わせに対する応答は、その応答を受け取ったときだけ保持する
+            self.resp_packets_[Key().asset_missing] = r_dict.get(Key().asset_missing)
+
+            data_id = r_dict[Key().data_id]
+            while len(self.in_flight_) > 0 and self.in_flight_[0] <= data_id:
+                self.in_flight_.popleft()
+        return True
+
+    def upload_assets_(self, paths):
+        #画像のハッシュ値をサーバーに問い合わせ、サーバーに無い画像だけを分割して送信する
+        #返り値は パス -> (ファイル名, 内容, ハッシュ値, 送信済みかどうか) の辞書
+        assets = read_assets_(paths)
+
+        digests = list({asset[2] for asset in assets.values()})
+        self.send_({Key().asset_query : digests}, sync=True)
+        missing = self.resp_packets_.get(Key().asset_missing)
+        if missing is None:
+            #問い合わせに対応していないサーバーには画像本体をそのまま送る
+            return {path : asset + (False,) for path, asset in assets.items()}
+
+        sent = set()
+        for f_name, data, digest in assets.values():
+            if digest in missing and digest not in sent:
+                self.send_chunks_(f_name, data, digest)
+                sent.add(digest)
+
+        return {path : asset + (True,) for path, asset in assets.items()}
+
+    def send_chunks_(self, f_name, data, digest):
+        for packets in chunk_packets_(f_name, data, digest, self.chunk_sz_):
+            self.send_(packets)
+
+    def send_mode_(self, r_asset, l_asset, mode_id):
+        return self.send_(mode_packets_(r_asset, l_asset, mode_id))
+
+    def send_(self, packets, sync=False):
+        #送信したコマンドの応答は、max_in_flightが1の場合とsyncがTrueの場合はすぐに待ち、
+        #それ以外は応答を待つコマンドが上限に達したときにまとめて受信する
+        with self.mutex_:
+            data_id = self.data_id_
+            packets[Key().data_id] = data_id
+            packets[Key().face_id] = self.face_id_
+
+            while len(self.in_flight_) >= self.max_in_flight_ and self.update_response_():
+                pass
+
+            result = send(self.client, packets, binary=self.binary_)
+            self.in_flight_.append(data_id)
+            self.data_id_ += 1
+
+            if sync or self.max_in_flight_ == 1:
+                while len(self.in_flight_) > 0 and self.in_flight_[0] <= data_id and self.update_response_():
+                    pass
+        return result
+
+#EyesControlClientと同じ動作をasyncioで実行するクラス
+#(各コマンドは送信し終えた時点で返り、サーバーの応答は返り値のFutureで受け取る)
+class AsyncEyesControlClient:
+
+    def __init__(self, ip, port, face_id=0, chunk_sz=64*1024, max_in_flight=8):
+        '''
+        クラスコンストラクタ(接続はconnect()で行う)
+
+        Parameters
+        ----------
+        ip      : string
+            接続先のIPアドレス
+
+        port    : int
+            接続するポート
+
+        face_id : int
+            制御する顔のID(サーバーが複数の顔を描画している場合)
+
+        chunk_sz: int
+            画像を分割して送信する場合の1回あたりの大きさ[bytes]
+
+        max_in_flight   : int
+            応答を待たずに送信できるコマンドの数(上限に達した場合は応答が届くまで送信を待つ)
+        '''
+
+        self.ip_ = ip
+        self.port_ = port
+        self.data_id_ = 0
+        self.face_id_ = face_id
+        self.chunk_sz_ = chunk_sz
+        self.max_in_flight_ = max(1, max_in_flight)
+        self.binary_ = False
+
+        self.reader_ = None
+        self.writer_ = None
+        self.recv_task_ = None
+        #応答を待っているコマンドの(データID, Future)(送信順)
+        self.in_flight_ = deque()
+        self.slots_ = None
+
+        self.resp_packets_ = {
+            Key().data_id : -1,
+            Key().mode_num : 0
+        }
+
+    async def connect(self):
+        '''
+        サーバーに接続する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+
+        self.reader_, self.writer_ = await asyncio.open_connection(self.ip_, self.port_)
+        self.slots_ = asyncio.Semaphore(self.max_in_flight_)
+        self.recv_task_ = asyncio.get_running_loop().create_task(self.on_receive_())
+
+        #EyesControlClientと同じく、サーバーが対応していればバイナリ形式に切り替える
+        await (await self.send_({Key().proto_ver : WIRE_VERSION}))
+        self.binary_ = self.resp_packets_.get(Key().proto_ver, 1) >= WIRE_VERSION
+
+    async def close(self):
+        '''
+        送信済みのコマンドの応答を待ってから切断する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+
+        if self.writer_ is None:
+            return
+        await self.flush()
+        self.writer_.close()
+        try:
+            await self.writer_.wait_closed()
+        except OSError:
+            pass
+        await asyncio.gather(self.recv_task_, return_exceptions=True)
+        self.writer_ = None
+
+    async def set_pos(self, x, y):
+        '''
+        瞳の位置をサーバーに送信する関数
+
+        Parameters
+        ----------
+        x   : float
+            眼のx座標((横方向のpixel数)*0.0-1.0)
+
+        y   : float
+            眼のy座標((縦方向のpixel数)*0.0-1.0)
+
+        Returns
+        -------
+        future  : asyncio.Future
+            サーバーの応答(辞書)が届いたときに完了するFuture
+        '''
+
+        return await self.send_({
+            Key().x_pos : x,
+            Key().y_pos : y
+        })
+
+    async def set_blink_interval(self, period, loop_num=2):
+        '''
+        瞬きの間隔をサーバーに送信する関数
+
+        Parameters
+        ----------
+        period      : float
+            瞬きの間隔(画像を再生する周期)[sec]
+
+        loop_num    : int
+            1回の瞬きにおけるまぶたを閉じる回数[回]
+
+        Returns
+        -------
+        future  : asyncio.Future
+            サーバーの応答(辞書)が届いたときに完了するFuture
+        '''
+
+        return await self.send_({
+            Key().blink_period  : period,
+            Key().blink_num     : loop_num
+        })
+
+    async def set_mode(self, r_mode_id, l_mode_id):
+        '''
+        瞳のモードをサーバーに送信する関数
+
+        Parameters
+        ----------
+        r_mode_id   : int
+            右の瞳のモード
+
+        l_mode_id   : int
+            左の瞳のモード
+
+        Returns
+        -------
+        future  : asyncio.Future
+            サーバーの応答(辞書)が届いたときに完了するFuture
+        '''
+
+        return await self.send_({
+            Key().right_mode    : r_mode_id,
+            Key().left_mode     : l_mode_id
+        })
+
+    async def add_mode(self, right_path, left_path=None, mode_id=-1):
+        '''
+        瞳の画像(またはgif画像)をサーバーに送信する関数
+        (サーバーが既に同じ内容の画像を持っている場合は画像本体を送信しない)
+
+        Parameters
+        ----------
+        right_path  : str
+            右目の画像ファイルパス
+
+        left_path   : str
+            左目の画像ファイルパス(未指定なら両目とも同じ画像で登録)
+
+        mode_id     : int
+            追加する瞳の表情モード位置(負値で最後尾に追加)
+
+        Returns
+        -------
+        future  : asyncio.Future
+            サーバーの応答(辞書)が届いたときに完了するFuture
+        '''
+
+        if left_path is None:
+            left_path = right_path
+
+        assets = await self.upload_assets_([right_path, left_path])
+        return await self.send_(mode_packets_(assets[right_path], assets[left_path], mode_id))
+
+    async def add_modes(self, right_paths, left_paths, head_m_id=-1):
+        '''
+        瞳の画像(またはgif画像)リストをサーバーに送信する関数
+        (サーバーが既に同じ内容の画像を持っている場合は画像本体を送信しない)
+
+        Parameters
+        ----------
+        right_paths : [str,...]
+            右目の画像ファイルパスのリスト
+
+        left_paths  : [str,...]
+            左目の画像ファイルパスのリスト
+
+        head_m_id   : int
+            追加する瞳の表情モードの先頭位置(負値で最後尾から追加)
+
+        Returns
+        -------
+        None
+        '''
+
+        assets = await self.upload_assets_(list(right_paths) + list(left_paths))
+
+        i = head_m_id
+        for (r, l) in zip(right_paths, left_paths):
+            await self.send_(mode_packets_(assets[r], assets[l], i if head_m_id > -1 else -1))
+            i += 1
+
+    def numof_mode(self):
+        '''
+        受信済みの最新の応答から、使用できる瞳モードの数を返す関数
+        (送信済みのコマンドを反映した数が必要な場合は、先にflush()を待つ)
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        mode_num    : int
+            サーバーに登録されている瞳モードの数
+        '''
+
+        return self.resp_packets_[Key().mode_num]
+
+    async def get_stats(self):
+        '''
+        サーバーから描画の処理時間の統計情報を取得する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            EyesControlClient.get_stats()と同じ
+        '''
+
+        resp = await (await self.send_({Key().stats : True}))
+        return resp.get(Key().stats, {})
+
+    def get_response(self):
+        '''
+        受信済みの最新の応答を返す関数
+
+        Parameters
+        ----------
+        None
 
-    def send_(self, packets):
-        packets[Key().data_id] = self.data_id_
-        result = send(self.client, packets)
-        self.update_response_()
+        Returns
+        -------
+        data : dict
+            サーバーからのレスポンス
+            data-id     : 受信された最新のデータID
+            mode-num    : サーバーに登録されている瞳モードの数
+        '''
+
+        return self.resp_packets_
+
+    async def flush(self):
+        '''
+        送信済みの全てのコマンドの応答を待つ関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        data_id : int
+            応答を受信した最新のデータID
+        '''
+
+        if len(self.in_flight_) > 0:
+            await asyncio.gather(*[future for _, future in self.in_flight_], return_exceptions=True)
+        return self.resp_packets_[Key().data_id]
+
+    def numof_in_flight(self):
+        '''
+        応答を待っているコマンドの数を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        num     : int
+            応答を待っているコマンドの数
+        '''
+
+        return len(self.in_flight_)
+
+    async def upload_assets_(self, paths):
+        #EyesControlClient.upload_assets_()と同じ
+        assets = read_assets_(paths)
+
+        digests = list({asset[2] for asset in assets.values()})
+        resp = await (await self.send_({Key().asset_query : digests}))
+        missing = resp.get(Key().asset_missing)
+        if missing is None:
+            return {path : asset + (False,) for path, asset in assets.items()}
+
+        sent = set()
+        for f_name, data, digest in assets.values():
+            if digest in missing and digest not in sent:
+                for packets in chunk_packets_(f_name, data, digest, self.chunk_sz_):
+                    await self.send_(packets)
+                sent.add(digest)
+
+        return {path : asset + (True,) for path, asset in assets.items()}
+
+    async def send_(self, packets):
+        #送信できる数に空きができるまで待ってから送信し、応答を受け取るFutureを返す
+        if self.writer_ is None:
+            raise ConnectionError('Not connected')
+        await self.slots_.acquire()
+        if self.recv_task_.done():
+            self.slots_.release()
+            raise ConnectionResetError('Connection closed by server')
+
+        data_id = self.data_id_
         self.data_id_ += 1
-        return result
+        packets[Key().data_id] = data_id
+        packets[Key().face_id] = self.face_id_
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight_.append((data_id, future))
+        self.writer_.write(frame_message(packets, self.binary_))
+        await self.writer_.drain()
+        return future
+
+    async def on_receive_(self):
+        #応答を受信するたびに、そのデータID以前のコマンドのFutureを完了する
+        error = ConnectionResetError('Connection closed by server')
+        try:
+            while True:
+                r_dict, _ = await read_message(self.reader_)
+                if r_dict is None:
+                    break
+                if len(r_dict.keys()) == 0:
+                    continue
+
+                self.resp_packets_[Key().data_id] = r_dict[Key().data_id]
+                self.resp_packets_[Key().mode_num] = r_dict[Key().mode_num]
+                for key in (Key().stats, Key().proto_ver):
+                    if key in r_dict:
+                        self.resp_packets_[key] = r_dict[key]
+
+                data_id = r_dict[Key().data_id]
+                while len(self.in_flight_) > 0 and self.in_flight_[0][0] <= data_id:
+                    _, future = self.in_flight_.popleft()
+                    if not future.done():
+                        future.set_result(r_dict)
+                    self.slots_.release()
+        except (OSError, ProtocolError) as e:
+            error = e
+        finally:
+            #切断された場合は応答を待っているコマンドを全て失敗させる
+            while len(self.in_flight_) > 0:
+                _, future = self.in_flight_.popleft()
+                if not future.done():
+                    future.set_exception(error)
+                    #応答を待たないコマンドのFutureで警告が出ないよう取得済みにする(切断は次の送信で例外になる)
+                    future.exception()
+                self.slots_.release()
+
+def read_asset_(path):
+    #画像ファイルを読み込み、(ファイル名, 内容, ハッシュ値)を返す
+    _, f_name = os.path.split(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return (f_name, data, hashlib.sha256(data).hexdigest())
+
+def read_assets_(paths):
+    #同じパスは一度だけ読み込み、パス -> (ファイル名, 内容, ハッシュ値) の辞書を返す
+    assets = {}
+    for path in paths:
+        if path not in assets:
+            assets[path] = read_asset_(path)
+    return assets
+
+def chunk_packets_(f_name, data, digest, chunk_sz):
+    #画像を分割して送信するパケットを順に返す
+    for offset in range(0, max(len(data), 1), chunk_sz):
+        chunk = {
+            Key().mode_hash     : digest,
+            Key().mode_fname    : f_name,
+            Key().chunk_offset  : offset,
+            Key().asset_size    : len(data),
+            Key().mode_bin      : data[offset:offset+chunk_sz]
+        }
+        yield {Key().asset_chunk : chunk}
+
+def mode_packets_(r_asset, l_asset, mode_id):
+    #画像パケットを作成して表情モードを登録するパケットを返す(送信済みの画像はハッシュ値だけを送る)
+    def image_packet(asset):
+        f_name, data, digest, is_uploaded = asset
+        if is_uploaded:
+            return {Key().mode_fname : f_name, Key().mode_hash : digest}
+        return {Key().mode_fname : f_name, Key().mode_bin : data}
+
+    if r_asset[2] == l_asset[2]:
+        return {
+            Key().rl_mode_img   : image_packet(r_asset),
+            Key().mode_id       : mode_id
+        }
+    return {
+        Key().right_mode_img: image_packet(r_asset),
+        Key().left_mode_img : image_packet(l_asset),
+        Key().mode_id       : mode_id
+    }
@@ -7,29 +7,137 @@ author  : Taiyou Komazawa
 date    : 2022/11/21
 '''
 
-import os.path, os
+import time
+import math
+import numbers
 
 import cv2
+import numpy as np
 
-import socket
-
+import asyncio
 import threading
+from collections import namedtuple
 
 from .lib_donmas_eye_base import *
+from .lib_frame_scheduler import FrameScheduler
+from .lib_frame_stats import FrameStats
+from .lib_asset_store import AssetStore, asset_digest
 from .lib_tcp_protocol import *
 from .donmas_eye_server_keys import HeaderKey as Key
 
-#眼の動作を制御するサーバーの動作を定義するクラス
-class EyesControlServer:
+#サーバーが受信した眼の制御状態のスナップショット(生成後は変更しない)
+# seq               : スナップショットの通し番号
+# pos, pos_seq      : 瞳の座標(y, x)と、それを更新したときの通し番号
+# blink, blink_seq  : 瞬きの(間隔, 回数)と、それを更新したときの通し番号
+# mode, mode_seq    : 瞳の表情モード(右, 左)と、それを更新したときの通し番号
+# right_modes       : 右目に登録されている瞳の画像(またはFrameStack)のタプル
+# left_modes        : 左目に登録されている瞳の画像(またはFrameStack)のタプル
+EyesState = namedtuple('EyesState', [
+    'seq',
+    'pos', 'pos_seq',
+    'blink', 'blink_seq',
+    'mode', 'mode_seq',
+    'right_modes', 'left_modes'
+])
+
+#分割して受信する画像1つの最大の大きさ[bytes]
+MAX_ASSET_SIZE = 64*1024*1024
+
+#1つの接続で同時に受信中にできる分割された画像の数と、その合計の大きさ[bytes]
+#(超えた場合は新しい画像の受信を拒否する)
+MAX_PENDING_UPLOADS = 8
+MAX_PENDING_UPLOAD_BYTES = 2*MAX_ASSET_SIZE
+
+#1つの接続で処理を待つメッセージの最大数(超えた場合はクライアントからの受信を待たせる)
+MAX_PENDING_MESSAGES = 256
+
+#UDPの通し番号を記録する送信元の最大数(超えた場合は記録を消して、次のデータグラムから受け付け直す)
+MAX_DATAGRAM_SENDERS = 1024
+
+def is_int_(value):
+    #整数(boolを除く)であればTrue
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+def is_count_(value):
+    #0以上の整数であればTrue
+    return is_int_(value) and value >= 0
+
+def is_finite_(value):
+    #有限の実数(boolを除く)であればTrue
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and math.isfinite(value)
+
+#1つの接続ごとの通信の状態をまとめたクラス
+class ClientSession:
+
+    def __init__(self, mode_num):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        mode_num    : int
+            接続時の顔ID 0の瞳表情モードの数(最初の応答に使う)
+        '''
+
+        #接続後に最初に制御された顔の表情モードを初期化するため、初期化済みの顔IDを記録する
+        self.reset_faces = set()
+        #この接続で受信中の分割された画像(ハッシュ値 -> (画像の大きさ, 受信済みのデータ))
+        self.uploads = {}
+        #クライアントへの応答(受信した最新のデータIDと瞳表情モードの数)
+        self.resp_packets = {
+            Key().data_id : 0,
+            Key().mode_num : mode_num
+        }
 
-    def __init__(self, bg, obj_right : Eye, obj_left : Eye, obj_eyelid : EyeLid, port, timeout=10):
+#UDPで送られた瞳の座標を反映するクラス(通信スレッドのイベントループで実行される)
+class EyesDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        server  : EyesControlServer class object
+            座標を反映するサーバー
+        '''
+
+        self.server_ = server
+        #(送信元, 顔ID) -> 最後に受け付けた通し番号
+        self.last_seq_ = {}
+
+    def datagram_received(self, data, addr):
+        dgram = unpack_datagram(data)
+        if dgram is None:
+            return
+        kind, face_id, seq, x, y = dgram
+        if kind != DGRAM_POS or face_id >= self.server_.numof_face():
+            return
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return
+
+        #古い(順番が入れ替わった)データグラムは破棄する
+        key = (addr, face_id)
+        last = self.last_seq_.get(key)
+        if last is not None and not is_newer_seq(seq, last):
+            return
+        if last is None and len(self.last_seq_) >= MAX_DATAGRAM_SENDERS:
+            self.last_seq_.clear()
+        self.last_seq_[key] = seq
+
+        self.server_.publish_(face_id, pos=(y, x))
+
+#1組の眼(右目, 左目, まぶた)と、その描画用のバッファ・制御状態をまとめたクラス
+class EyesFace:
+
+    def __init__(self, bg, obj_right : Eye, obj_left : Eye, obj_eyelid : EyeLid, stats, incremental=True, buffer_num=2, skip_idle=True):
         '''
         クラスコンストラクタ
 
         Parameters
         ----------
         bg          : ndarray
-            バックグラウンド画像
+            バックグラウンド画像(拡大済み)
 
         obj_right   : Eye class object
             右目のクラスオブジェクト
@@ -40,50 +148,267 @@ class EyesControlServer:
         obj_eyelid  : Eyelid class object
             まぶたのクラスオブジェクト
 
-        port        : int
-            リッスンするポート
+        stats       : FrameStats
+            描画の段階ごとの処理時間の記録先
 
-        timeout     : int
-            受付の待ち時間
+        incremental, buffer_num, skip_idle :
+            EyesControlServerを参照
         '''
 
         self.bg_ = bg
         self.obj_right_ = obj_right
         self.obj_left_ = obj_left
         self.obj_eyelid_ = obj_eyelid
+        self.stats_ = stats
 
-        self.packets = {
-            Key().data_id : 0,
-            Key().x_pos : 0.5,
-            Key().y_pos : 0.5,
-            Key().blink_period : 3,
-            Key().blink_num : 2,
-            Key().right_mode : 0,
-            Key().left_mode : 0,
-
-            Key().right_mode_img : '',
-            Key().left_mode_img : '',
-            Key().rl_mode_img : '',
-            Key().mode_id     : -1
-        }
+        #描画用のバッファのリングと、各バッファに前回描写した矩形のリスト
+        self.incremental_ = incremental
+        self.frames_ = [self.bg_.copy() for _ in range(buffer_num)]
+        self.dirty_rects_ = [[] for _ in range(buffer_num)]
+        #拡大縮小後の出力バッファ(出力サイズが決まった時点で確保する)
+        self.outs_ = [None for _ in range(buffer_num)]
+        self.buf_idx_ = 0
 
-        self.resp_packets_ = {
-            Key().data_id : 0,
-            Key().mode_num : self.obj_right_.numof_mode()
-        }
+        #前回描画したときの右目, 左目, まぶたの世代番号
+        self.skip_idle_ = skip_idle
+        self.drawn_gens_ = None
+        self.is_updated_ = False
 
-        self.mutex_ = threading.Lock()
+        #描画スレッドから表示側へ渡すフレームと、表示側で使用中のバッファ番号
+        #(EyesControlServer.render_cv_を取得してから読み書きする)
+        self.ready_frame_ = None
+        self.held_idx_ = None
 
-        try:
-            os.makedirs('tmp_img/')
-        except FileExistsError:
-            pass
+        #通信スレッドは新しいスナップショットを作って参照を差し替えるだけで、
+        #描画側はロックを取らずに最新のスナップショットを読み出して眼に反映する
+        self.state_ = EyesState(
+            seq=0,
+            pos=(0.5, 0.5), pos_seq=0,
+            blink=(3, 2), blink_seq=0,
+            mode=(0, 0), mode_seq=0,
+            right_modes=tuple(self.obj_right_.pupils_),
+            left_modes=tuple(self.obj_left_.pupils_)
+        )
+        self.applied_state_ = self.state_
+
+        self.obj_right_.set_pos(*self.state_.pos)
+        self.obj_left_.set_pos(*self.state_.pos)
+        self.obj_eyelid_.set_interval(*self.state_.blink)
+
+    def next_idx_(self):
+        #次に描画するバッファ番号(表示側で使用中のバッファは避ける), 描画できない場合None
+        #(EyesControlServer.render_cv_を取得してから呼び出す)
+        idx = (self.buf_idx_ + 1) % len(self.frames_)
+        if idx == self.held_idx_:
+            #次のバッファが表示側で使用中であれば、直前のバッファに描き直す
+            idx = self.buf_idx_
+            if self.ready_frame_ is not None and self.ready_frame_[1] == idx:
+                #直前のバッファが表示側にまだ受け取られていなければ、上書きせずに見送る
+                return None
+        if idx == self.held_idx_:
+            return None
+        return idx
+
+    def render_(self, idx, dsize=None):
+        t0 = time.perf_counter()
+        self.apply_state_()
+        gens = (self.obj_right_.update(), self.obj_left_.update(), self.obj_eyelid_.update())
+        self.stats_.record('state', time.perf_counter() - t0)
+
+        #何も変化していなければ前回描画したバッファをそのまま返す
+        if self.skip_idle_ and gens == self.drawn_gens_:
+            out = self.frames_[self.buf_idx_] if dsize is None else self.outs_[self.buf_idx_]
+            if out is not None and (dsize is None or out.shape[:2] == (dsize[1], dsize[0])):
+                self.is_updated_ = False
+                return out
+
+        self.is_updated_ = True
+        self.drawn_gens_ = gens
+        self.buf_idx_ = idx
+        src = self.draw_(idx)
+
+        if dsize is None:
+            return src
+
+        t0 = time.perf_counter()
+        out = self.outs_[idx]
+        if out is None or out.shape[:2] != (dsize[1], dsize[0]):
+            out = np.empty((dsize[1], dsize[0], src.shape[2]), dtype=src.dtype)
+            self.outs_[idx] = out
+
+        cv2.resize(src, dsize, dst=out)
+        self.stats_.record('resize', time.perf_counter() - t0)
+        return out
+
+    def draw_(self, idx):
+        frame = self.frames_[idx]
+
+        t0 = time.perf_counter()
+        if self.incremental_:
+            #このバッファに前回瞳・まぶたを描写した矩形だけ背景に戻す
+            for rect in self.dirty_rects_[idx]:
+                frame[rect[0]:rect[1], rect[2]:rect[3]] = self.bg_[rect[0]:rect[1], rect[2]:rect[3]]
+        else:
+            np.copyto(frame, self.bg_)
+        t1 = time.perf_counter()
+        r_rect = self.obj_right_.blit(frame)
+        t2 = time.perf_counter()
+        l_rect = self.obj_left_.blit(frame)
+        t3 = time.perf_counter()
+        lid_rect = self.obj_eyelid_.blit(frame)
+        t4 = time.perf_counter()
+
+        self.stats_.record('restore', t1 - t0)
+        self.stats_.record('right', t2 - t1)
+        self.stats_.record('left', t3 - t2)
+        self.stats_.record('eyelid', t4 - t3)
+
+        self.dirty_rects_[idx] = [rect for rect in (r_rect, l_rect, lid_rect) if rect is not None]
+
+        return frame
+
+    def render_batch_(self, pos, modes=None, times=None, lid_idxs=None):
+        self.apply_state_()
+
+        r_modes = l_modes = None
+        if modes is not None:
+            modes = np.broadcast_to(np.asarray(modes), (len(pos), 2))
+            r_modes, l_modes = modes[:, 0], modes[:, 1]
+
+        t0 = time.perf_counter()
+        dst = np.empty((len(pos),) + self.bg_.shape, dtype=self.bg_.dtype)
+        dst[...] = self.bg_
+        self.obj_right_.draw_batch(dst, pos, r_modes, times)
+        self.obj_left_.draw_batch(dst, pos, l_modes, times)
+        if lid_idxs is not None:
+            self.obj_eyelid_.draw_batch(dst, lid_idxs)
+        self.stats_.record('batch', time.perf_counter() - t0)
+
+        return dst
+
+    def apply_state_(self):
+        #最新のスナップショットを一度だけ読み出し、前回反映したものから変化した項目を眼に反映する
+        state = self.state_
+        applied = self.applied_state_
+        if state is applied:
+            return
+
+        if state.right_modes is not applied.right_modes:
+            self.sync_modes_(self.obj_right_, state.right_modes)
+        if state.left_modes is not applied.left_modes:
+            self.sync_modes_(self.obj_left_, state.left_modes)
 
-        self.set_pos_()
-        self.set_interval_()
+        #受信した順に反映する(表情モードの変更は瞳の位置を中心に戻すため)
+        updates = []
+        if state.pos_seq != applied.pos_seq:
+            updates.append((state.pos_seq, self.set_pos_))
+        if state.blink_seq != applied.blink_seq:
+            updates.append((state.blink_seq, self.set_interval_))
+        if state.mode_seq != applied.mode_seq:
+            updates.append((state.mode_seq, self.set_mode_))
+        for _, update in sorted(updates, key=lambda u: u[0]):
+            update(state)
+
+        self.applied_state_ = state
+
+    def sync_modes_(self, obj, modes):
+        for i, img in enumerate(modes):
+            if i >= obj.numof_mode() or obj.pupils_[i] is not img:
+                obj.add_mode(img, i, prepared=True)
+
+    def set_pos_(self, state):
+        y, x = state.pos
+        self.obj_right_.set_pos(y, x)
+        self.obj_left_.set_pos(y, x)
+
+    def set_interval_(self, state):
+        interval, num = state.blink
+        self.obj_eyelid_.set_interval(interval, num)
+
+    def set_mode_(self, state):
+        rmode, lmode = state.mode
+        self.obj_right_.change_mode(rmode)
+        self.obj_left_.change_mode(lmode)
+
+#眼の動作を制御するサーバーの動作を定義するクラス
+class EyesControlServer:
+
+    def __init__(self, bg, obj_right : Eye, obj_left : Eye, obj_eyelid : EyeLid, port, timeout=10, incremental=True, buffer_num=2, scale=1.0, skip_idle=True, assets=None, max_frame_sz=MAX_FRAME_SIZE, udp_port=None):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        bg          : ndarray
+            バックグラウンド画像
+
+        obj_right   : Eye class object
+            右目のクラスオブジェクト(顔ID 0)
+
+        obj_left    : Eye class object
+            左目のクラスオブジェクト(顔ID 0)
+
+        obj_eyelid  : Eyelid class object
+            まぶたのクラスオブジェクト(顔ID 0)
+
+        port        : int
+            リッスンするポート
+
+        timeout     : int
+            (互換性のために残している引数。接続の受付はイベントループで待つため使用しない)
+
+        incremental : bool
+            前フレームから変化した矩形だけを描き直す差分描画を行うかどうか
+
+        buffer_num  : int
+            描画に使う作業・出力バッファの数(リングバッファとして順に使用する)
+
+        scale       : float or (float, float)
+            出力画像の拡大率(縦横共通, または(縦方向, 横方向))
+            背景は起動時に一度だけ拡大され、以降は拡大後の解像度で直接描画する
+            (obj_right, obj_left, obj_eyelidにも同じ拡大率を指定しておくこと)
+
+        skip_idle   : bool
+            眼とまぶたの状態が前回の描画から変化していなければ描き直さずに前回の画像を使うかどうか
+
+        assets      : AssetStore
+            受信した瞳の画像を登録する素材ストア(Noneの場合はディスクキャッシュなしで作成する)
+
+        max_frame_sz: int
+            受信できるメッセージの最大の大きさ[bytes](超えたメッセージを送ったクライアントは切断する)
+
+        udp_port    : int
+            瞳の座標をUDPで受け付けるポート(Noneの場合は受け付けない)
+            (画像の登録や表情モードなどの他のコマンドはTCPで受け付ける)
+        '''
+
+        self.bg_ = scale_image(bg, scale)
+        self.incremental_ = incremental
+        self.buffer_num_ = buffer_num
+        self.skip_idle_ = skip_idle
+
+        #描画の段階ごとの処理時間とロックの待ち時間の記録
+        self.stats_ = FrameStats()
+
+        #顔IDの順に並べた眼の組(add_face()で追加する)
+        self.faces_ = []
+        self.add_face(obj_right, obj_left, obj_eyelid)
+
+        #描画スレッドから表示側へ渡すフレームの受け渡し用
+        self.render_cv_ = threading.Condition()
+        self.render_th_ = None
+        self.scheduler_ = None
+        self._is_rendering_ = False
+
+        #スナップショットを更新する通信スレッドと画像のデコードを行うスレッドの排他用(描画側では使用しない)
+        self.mutex_ = threading.Lock()
+
+        #受信した瞳の画像を内容のハッシュ値で管理し、同じ画像は一度だけデコードする
+        self.assets_ = assets if assets is not None else AssetStore('tmp_img/')
+        self.max_frame_sz_ = max_frame_sz
 
         self._is_alive_ = True
-        self.init_socket_('', port, timeout)
+        self.init_socket_('', port, timeout, udp_port)
 
     def __del__(self):
         '''
@@ -92,27 +417,323 @@ class EyesControlServer:
 
         self.close()
 
-    def get_image(self):
+    def add_face(self, obj_right : Eye, obj_left : Eye, obj_eyelid : EyeLid):
         '''
-        現在の眼の画像を出力します。
+        眼の組(顔)を追加します。全ての顔は同じ描画スレッドで描画されます。
+        同じ素材の顔を追加する場合は、Eye.clone(), EyeLid.clone()で
+        デコード済みの画像を共有したオブジェクトを渡してください。
+        描画スレッドの開始前に呼んでください。
+
+        Parameters
+        ----------
+        obj_right   : Eye class object
+            右目のクラスオブジェクト
+
+        obj_left    : Eye class object
+            左目のクラスオブジェクト
+
+        obj_eyelid  : Eyelid class object
+            まぶたのクラスオブジェクト
+            (背景と拡大率は全ての顔で共通)
+
+        Returns
+        -------
+        face_id : int
+            追加した顔のID
+        '''
+
+        self.faces_.append(EyesFace(self.bg_, obj_right, obj_left, obj_eyelid, self.stats_,
+                                    self.incremental_, self.buffer_num_, self.skip_idle_))
+        return len(self.faces_) - 1
+
+    def numof_face(self):
+        '''
+        顔の数を返します。
 
         Parameters
         ----------
         None
 
+        Returns
+        -------
+        len     : int
+            顔の数
+        '''
+
+        return len(self.faces_)
+
+    def set_skip_idle(self, skip_idle):
+        '''
+        眼とまぶたの状態が前回の描画から変化していない場合に描き直しを省くかどうかを設定します。
+        (全ての顔に設定され、以降に追加する顔にも使われます。ベンチマークなどで毎回描画させる場合はFalse)
+
+        Parameters
+        ----------
+        skip_idle   : bool
+            変化がなければ描き直さずに前回の画像を使うかどうか
+
+        Returns
+        -------
+        None
+        '''
+
+        self.skip_idle_ = skip_idle
+        for face in self.faces_:
+            face.skip_idle_ = skip_idle
+
+    def get_image(self, face_id=0):
+        '''
+        現在の眼の画像を出力します。
+
+        Parameters
+        ----------
+        face_id : int
+            顔ID
+
         Returns
         -------
         dst     : ndarray
             眼が描画された画像
+            内部のバッファであり、リングを一巡してそのバッファが再び使われるまで有効
+            (前回から変化がない場合は前回と同じバッファを返す。is_updated()を参照)
         '''
 
-        self.mutex_.acquire()
-        r = self.obj_right_.spin_once(self.bg_)
-        rl = self.obj_left_.spin_once(r)
-        dst = self.obj_eyelid_.spin_once(rl)
-        self.mutex_.release()
+        face = self.faces_[face_id]
+        return face.render_((face.buf_idx_ + 1) % len(face.frames_))
 
-        return dst
+    def get_scaled_image(self, dsize, face_id=0):
+        '''
+        現在の眼の画像を指定の大きさに拡大縮小して出力します。
+
+        Parameters
+        ----------
+        dsize   : (int, int)
+            出力画像の大きさ(幅, 高さ)
+
+        face_id : int
+            顔ID
+
+        Returns
+        -------
+        dst     : ndarray
+            眼が描画された画像
+            内部のバッファであり、リングを一巡してそのバッファが再び使われるまで有効
+            (前回から変化がない場合は前回と同じバッファを返す。is_updated()を参照)
+        '''
+
+        face = self.faces_[face_id]
+        return face.render_((face.buf_idx_ + 1) % len(face.frames_), dsize)
+
+    def render_batch(self, pos, modes=None, times=None, lid_idxs=None, face_id=0):
+        '''
+        複数フレーム分の眼の画像をまとめて出力します。(プレビューやサムネイルの作成用)
+        受信済みの状態を反映した上で描画しますが、眼の状態は変更しません。
+        描画スレッドの実行中には呼ばないでください。
+
+        Parameters
+        ----------
+        pos         : ndarray
+            各フレームの瞳の位置(フレーム数, 2)。各行は(y, x)
+        modes       : ndarray
+            各フレームの瞳の表情モード(フレーム数, 2)。各行は(右, 左)(Noneの場合は現在のモード)
+        times       : ndarray
+            各フレームのgifの再生開始からの経過時間[sec](Noneの場合は現在の経過時間)
+        lid_idxs    : ndarray
+            各フレームのまぶたのフレーム番号(負値で描写しない, Noneの場合はまぶたを描写しない)
+        face_id     : int
+            顔ID
+
+        Returns
+        -------
+        dst     : ndarray
+            眼が描画された画像の配列(フレーム数, 高さ, 幅, 3)
+        '''
+
+        return self.faces_[face_id].render_batch_(pos, modes, times, lid_idxs)
+
+    def is_updated(self, face_id=0):
+        '''
+        直前のget_image(), get_scaled_image()または描画スレッドで新しい画像が描画されたかを返します。
+
+        Parameters
+        ----------
+        face_id : int
+            顔ID
+
+        Returns
+        -------
+        rlt     : bool
+            描画された場合True, 状態が変化していないため前回の画像を返した場合False
+        '''
+
+        return self.faces_[face_id].is_updated_
+
+    def start_render(self, fps=30.0, dsize=None):
+        '''
+        一定のフレームレートで眼の画像を描画するスレッドを開始します。
+        描画された画像はwait_frame()またはwait_frames()で取得します。
+
+        Parameters
+        ----------
+        fps     : float
+            目標のフレームレート[fps](0以下で待機せずに最大速度で描画する)
+
+        dsize   : (int, int)
+            出力画像の大きさ(幅, 高さ)。Noneの場合は拡大縮小しない
+
+        Returns
+        -------
+        None
+        '''
+
+        self.stop_render()
+
+        self.scheduler_ = FrameScheduler(fps)
+        self._is_rendering_ = True
+        self.render_th_ = threading.Thread(target=self.on_render_, args=[dsize])
+        self.render_th_.setDaemon(True)
+        self.render_th_.start()
+
+    def stop_render(self):
+        '''
+        描画スレッドを終了します。
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+
+        with self.render_cv_:
+            self._is_rendering_ = False
+            self.render_cv_.notify_all()
+
+        if self.render_th_ is not None:
+            self.render_th_.join()
+            self.render_th_ = None
+
+    def wait_frame(self, timeout=None):
+        '''
+        描画スレッドが顔ID 0の新しい画像を描画するまで待ち、その画像を返します。
+        返された画像は次にwait_frame()を呼ぶまで上書きされません。
+
+        Parameters
+        ----------
+        timeout : float
+            最大の待ち時間[sec](Noneで無制限)
+
+        Returns
+        -------
+        dst     : ndarray or None
+            眼が描画された画像。時間内に描画されなかった場合None
+        '''
+
+        dsts = self.wait_frames(timeout)
+        if dsts is None:
+            return None
+        return dsts[0]
+
+    def wait_frames(self, timeout=None):
+        '''
+        描画スレッドがいずれかの顔の新しい画像を描画するまで待ち、全ての顔の画像を返します。
+        返された画像は次にwait_frames()を呼ぶまで上書きされません。
+
+        Parameters
+        ----------
+        timeout : float
+            最大の待ち時間[sec](Noneで無制限)
+
+        Returns
+        -------
+        dsts    : [ndarray or None, ...] or None
+            顔IDの順に並べた眼が描画された画像のリスト(前回から描画されていない顔はNone)
+            時間内にどの顔も描画されなかった場合None
+        '''
+
+        with self.render_cv_:
+            #前回渡したバッファを解放する
+            for face in self.faces_:
+                face.held_idx_ = None
+            self.render_cv_.notify_all()
+
+            is_ready = lambda: any(face.ready_frame_ is not None for face in self.faces_)
+            if not self.render_cv_.wait_for(lambda: is_ready() or not self._is_rendering_, timeout):
+                return None
+            if not is_ready():
+                return None
+
+            dsts = []
+            for face in self.faces_:
+                if face.ready_frame_ is None:
+                    dsts.append(None)
+                    continue
+                dst, face.held_idx_ = face.ready_frame_
+                face.ready_frame_ = None
+                dsts.append(dst)
+
+        return dsts
+
+    def record_stage(self, stage, sec):
+        '''
+        サーバーの外で行った処理(表示など)の処理時間を記録します。
+
+        Parameters
+        ----------
+        stage   : string
+            段階の名前
+
+        sec     : float
+            処理時間[sec]
+
+        Returns
+        -------
+        None
+        '''
+
+        self.stats_.record(stage, sec)
+
+    def get_stats(self):
+        '''
+        描画の段階ごとの処理時間とフレーム周期の統計情報を返します。
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            stages      : 段階ごとの処理時間の統計(FrameStats.get_stats()の返り値, 全ての顔の合計)
+            hist-edges  : ヒストグラムの区間の境界[sec]
+            render      : フレーム周期の統計(get_render_stats()の返り値)
+        '''
+
+        return {
+            'stages'    : self.stats_.get_stats(),
+            'hist-edges': self.stats_.get_hist_edges(),
+            'render'    : self.get_render_stats()
+        }
+
+    def get_render_stats(self):
+        '''
+        描画スレッドのフレーム周期の統計情報を返します。
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            FrameScheduler.get_stats()の返り値(描画スレッド未開始の場合は空の辞書)
+        '''
+
+        if self.scheduler_ is None:
+            return {}
+        return self.scheduler_.get_stats()
 
     def close(self):
         '''
@@ -127,153 +748,411 @@ class EyesControlServer:
         None
         '''
 
+        self.stop_render()
+        if not self._is_alive_:
+            return
         self._is_alive_ = False
-        self.server_.close()
+
+        #イベントループ上で受付と接続を閉じてから、ループを止める
+        asyncio.run_coroutine_threadsafe(self.shutdown_(), self.loop_).result()
+        self.loop_.call_soon_threadsafe(self.loop_.stop)
         self.th_.join()
+        self.loop_.close()
 
-    def add_mode_(self, is_single_img):
+    def on_render_(self, dsize):
+        while self._is_rendering_:
+            self.scheduler_.wait()
 
-        result = False
+            #1回の周期で全ての顔を順に描画する
+            is_skipped = False
+            for face in self.faces_:
+                with self.render_cv_:
+                    idx = face.next_idx_()
+                if idx is None:
+                    is_skipped = True
+                    continue
 
-        if is_single_img:
-            f_bin = self.packets[Key().rl_mode_img]
-            mode_id = self.packets[Key().mode_id]
+                dst = face.render_(idx, dsize)
+                if not face.is_updated_:
+                    #前回から変化していないため表示側には渡さない
+                    continue
 
-            fpath = 'tmp_img/'+f_bin[Key().mode_fname]
+                with self.render_cv_:
+                    face.ready_frame_ = (dst, idx)
+                    self.render_cv_.notify_all()
 
-            f = open(fpath, 'wb')
-            f.write(f_bin[Key().mode_bin])
-            f.close()
+            if is_skipped:
+                self.scheduler_.skip()
 
-            _, ext = os.path.splitext(fpath)
-            if ext == '.gif':
-                result |= self.obj_right_.add_mode(cv2.VideoCapture(fpath), mode_id)
-                result |= self.obj_left_.add_mode(cv2.VideoCapture(fpath), mode_id)
-            else:
-                result |= self.obj_right_.add_mode(cv2.imread(fpath, cv2.IMREAD_COLOR), mode_id)
-                result |= self.obj_left_.add_mode(cv2.imread(fpath, cv2.IMREAD_COLOR), mode_id)
+    def publish_(self, face_id=0, **fields):
+        #現在のスナップショットから指定された項目だけ差し替えた新しいスナップショットを公開する
+        #(複数の項目は指定した順に反映されるよう、項目ごとに通し番号を進める)
+        face = self.faces_[face_id]
+        self.lock_()
+        seq = face.state_.seq
+        for name in list(fields):
+            if name in ('pos', 'blink', 'mode'):
+                seq += 1
+                fields[name + '_seq'] = seq
+        face.state_ = face.state_._replace(seq=max(seq, face.state_.seq + 1), **fields)
+        self.mutex_.release()
+
+    def publish_modes_(self, r_img, l_img, mode_id, face_id=0):
+        face = self.faces_[face_id]
+        self.lock_()
+        state = face.state_
+        face.state_ = state._replace(
+            seq=state.seq + 1,
+            right_modes=self.replace_mode_(state.right_modes, r_img, mode_id),
+            left_modes=self.replace_mode_(state.left_modes, l_img, mode_id)
+        )
+        self.mutex_.release()
+
+    def lock_(self):
+        t0 = time.perf_counter()
+        self.mutex_.acquire()
+        self.stats_.record('lock-wait', time.perf_counter() - t0)
+
+    def replace_mode_(self, modes, img, mode_id):
+        #Eye.add_mode()と同じ規則でモードを追加・上書きしたタプルを返す
+        if img is None:
+            return modes
+        if mode_id >= len(modes) or mode_id < 0:
+            return modes + (img,)
+        return modes[:mode_id] + (img,) + modes[mode_id+1:]
+
+    def load_mode_img_(self, obj, f_bin, missing=None):
+        #受信した画像を素材ストアでデコード・拡大する(ロックの外で実行する)
+        #同じ内容の画像は一度だけデコードされ、同じ拡大率の眼には同じ参照が返される
+        #(送信済みとして参照された画像が素材ストアに無い場合は、そのハッシュ値をmissingに加える)
+        if not isinstance(f_bin, dict):
+            raise ProtocolError('invalid mode image')
+        if Key().mode_bin in f_bin:
+            data = f_bin[Key().mode_bin]
+            fname = f_bin.get(Key().mode_fname, '')
+            if not isinstance(data, bytes) or not isinstance(fname, str):
+                raise ProtocolError('invalid mode image')
+            digest = self.assets_.put(data, fname)
         else:
-            rf_bin = self.packets[Key().right_mode_img]
-            lf_bin = self.packets[Key().left_mode_img]
-            mode_id = self.packets[Key().mode_id]
-
-            rfpath = 'tmp_img/'+rf_bin[Key().mode_fname]
-            lfpath = 'tmp_img/'+lf_bin[Key().mode_fname]
-
-            rf = open(rfpath, 'wb')
-            lf = open(lfpath, 'wb')
-            rf.write(rf_bin[Key().mode_bin])
-            lf.write(lf_bin[Key().mode_bin])
-            rf.close()
-            lf.close()
-
-            _, ext = os.path.splitext(rfpath)
-            if ext == '.gif':
-                result |= self.obj_right_.add_mode(cv2.VideoCapture(rfpath), mode_id)
-            else:
-                result |= self.obj_right_.add_mode(cv2.imread(rfpath, cv2.IMREAD_COLOR), mode_id)
+            #ハッシュ値だけが送られた場合は送信済みの画像を使う
+            digest = f_bin.get(Key().mode_hash)
+            if not isinstance(digest, str):
+                raise ProtocolError('invalid mode image hash')
+            if digest not in self.assets_:
+                print('[des]Unknown image hash: {0}'.format(digest))
+                if missing is not None and digest not in missing:
+                    missing.append(digest)
+                return None
+        if digest is None:
+            return None
+        return self.assets_.prepare(digest, obj)
 
-            _, ext = os.path.splitext(lfpath)
-            if ext == '.gif':
-                result |= self.obj_left_.add_mode(cv2.VideoCapture(lfpath), mode_id)
-            else:
-                result |= self.obj_left_.add_mode(cv2.imread(lfpath, cv2.IMREAD_COLOR), mode_id)
-        if result:
-            print('Add mode done!')
+    def find_missing_(self, digests):
+        #問い合わせられたハッシュ値のうち、素材ストアに無いものを返す
+        return [digest for digest in digests if digest not in self.assets_]
 
-    def set_pos_(self):
-        y = self.packets[Key().y_pos]
-        x = self.packets[Key().x_pos]
-        self.obj_right_.set_pos(y, x)
-        self.obj_left_.set_pos(y, x)
+    def receive_chunk_(self, chunk, uploads):
+        #分割して送られた画像をつなぎ合わせ、全て揃ったらハッシュ値を確かめて素材ストアに登録する
+        if not isinstance(chunk, dict):
+            raise ProtocolError('invalid image chunk')
+        digest = chunk.get(Key().mode_hash)
+        size = chunk.get(Key().asset_size)
+        offset = chunk.get(Key().chunk_offset)
+        data = chunk.get(Key().mode_bin)
+        fname = chunk.get(Key().mode_fname, '')
+        if not (isinstance(digest, str) and is_count_(size) and is_count_(offset) and
+                isinstance(data, bytes) and isinstance(fname, str)):
+            raise ProtocolError('invalid image chunk')
 
-    def set_interval_(self):
-        interval = self.packets[Key().blink_period]
-        num = self.packets[Key().blink_num]
-        self.obj_eyelid_.set_interval(interval, num)
+        if offset == 0:
+            if size > MAX_ASSET_SIZE:
+                print('[des]Image is too large: {0} bytes'.format(size))
+                return
+            #同じ画像を最初から送り直す場合は、受信中のデータを破棄してから数える
+            uploads.pop(digest, None)
+            pending_sz = sum(upload[0] for upload in uploads.values())
+            if len(uploads) >= MAX_PENDING_UPLOADS or pending_sz + size > MAX_PENDING_UPLOAD_BYTES:
+                print('[des]Too many pending images: {0} ({1} images, {2} bytes)'.format(digest, len(uploads), pending_sz))
+                return
+            uploads[digest] = (size, bytearray())
+        upload = uploads.get(digest)
+        if upload is None or size != upload[0] or offset != len(upload[1]) or offset + len(data) > size:
+            print('[des]Unexpected image chunk: {0} (offset {1})'.format(digest, offset))
+            uploads.pop(digest, None)
+            return
 
-    def set_mode_(self):
-        rmode = self.packets[Key().right_mode]
-        lmode = self.packets[Key().left_mode]
-        self.obj_right_.change_mode(rmode)
-        self.obj_left_.change_mode(lmode)
+        buf = upload[1]
 
-    def init_socket_(self, ip, port, timeout=10):
-        self.server_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_.bind((ip, port))
-        self.server_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_.settimeout(timeout)
-        self.server_.listen(3)
+        buf += data
+        if len(buf) < size:
+            return
 
-        self.th_ = threading.Thread(target=self.on_host_waiting_)
+        del uploads[digest]
+        if asset_digest(bytes(buf)) != digest:
+            print('[des]Image hash mismatch: {0}'.format(digest))
+            return
+        self.assets_.put(bytes(buf), fname)
+
+    def add_mode_(self, r_dict, is_single_img, face_id=0, missing=None):
+        face = self.faces_[face_id]
+        #表情モード番号が無い場合はEyesControlClient.add_mode()と同じく末尾に追加する
+        mode_id = r_dict.get(Key().mode_id, -1)
+        if not is_int_(mode_id):
+            raise ProtocolError('invalid mode id')
+
+        if is_single_img:
+            r_img = self.load_mode_img_(face.obj_right_, r_dict[Key().rl_mode_img], missing)
+            l_img = self.load_mode_img_(face.obj_left_, r_dict[Key().rl_mode_img], missing)
+        else:
+            r_img = self.load_mode_img_(face.obj_right_, r_dict[Key().right_mode_img], missing)
+            l_img = self.load_mode_img_(face.obj_left_, r_dict[Key().left_mode_img], missing)
+
+        #デコードが終わってから参照の差し替えだけで登録する
+        self.publish_modes_(r_img, l_img, mode_id, face_id)
+        if r_img is not None or l_img is not None:
+            print('Add mode done!')
+
+    def init_socket_(self, ip, port, timeout=10, udp_port=None):
+        #全ての接続を1つのイベントループ(通信スレッド)で処理する
+        self.loop_ = asyncio.new_event_loop()
+        self.th_ = threading.Thread(target=self.loop_.run_forever)
         self.th_.setDaemon(True)
         self.th_.start()
 
-    def on_host_waiting_(self):
-        while self._is_alive_ != False:
+        #接続ごとの処理タスク(終了時にまとめてキャンセルする)
+        self.clients_ = set()
+
+        self.server_ = None
+        self.udp_ = None
+        try:
+            self.server_ = asyncio.run_coroutine_threadsafe(
+                asyncio.start_server(self.on_process_, ip, port, reuse_address=True), self.loop_).result()
+            if udp_port is not None:
+                self.udp_, _ = asyncio.run_coroutine_threadsafe(
+                    self.loop_.create_datagram_endpoint(lambda: EyesDatagramProtocol(self),
+                                                        local_addr=(ip or '0.0.0.0', udp_port)), self.loop_).result()
+                #受信バッファは既定の大きさのままにする(受信が遅れた場合に古い座標が溜まって表示が遅れないように)
+        except BaseException:
+            #ポートを開けなかった場合は開いたポートを閉じ、イベントループを止めてから例外を返す
+            if self.server_ is not None:
+                self.loop_.call_soon_threadsafe(self.server_.close)
+            self.loop_.call_soon_threadsafe(self.loop_.stop)
+            self.th_.join()
+            self.loop_.close()
+            self._is_alive_ = False
+            raise
+
+    async def shutdown_(self):
+        #新しい接続の受付を止め、接続中の処理をキャンセルしてから画像のデコードの終了を待つ
+        self.server_.close()
+        if self.udp_ is not None:
+            self.udp_.close()
+        for task in list(self.clients_):
+            task.cancel()
+        await asyncio.gather(*self.clients_, return_exceptions=True)
+        await self.server_.wait_closed()
+        await self.loop_.shutdown_default_executor()
+
+    async def on_process_(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print('[des]Connected from {0}.'.format(addr))
+        task = asyncio.current_task()
+        self.clients_.add(task)
+
+        session = ClientSession(len(self.faces_[0].state_.right_modes))
+
+        #受信したメッセージは受信タスクからキューで受け取り、溜まっている分をまとめて処理する
+        queue = asyncio.Queue(MAX_PENDING_MESSAGES)
+        recv_task = self.loop_.create_task(self.on_receive_(reader, queue, addr))
+
+        try:
+            is_open = True
+            while is_open:
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                if batch[-1] is None:
+                    #受信タスクが終了した(切断, または不正なメッセージ)
+                    is_open = False
+                    batch.pop()
+                if len(batch) == 0:
+                    continue
+
+                resp = await self.process_batch_(batch, session, addr)
+                #まとめて処理したメッセージには、最新のデータIDを付けた応答を1つだけ返す
+                writer.write(frame_message(resp, batch[-1][1]))
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            print('[des]Disconnected from client({0}).'.format(addr))
+        except ProtocolError as e:
+            print('[des]Invalid message from client({0}): {1}'.format(addr, e))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            recv_task.cancel()
+            self.clients_.discard(task)
+            print('Close connection.')
+            writer.close()
+
+    async def on_receive_(self, reader, queue, addr):
+        #メッセージを受信してキューに入れる(終了時はNoneを入れる)
+        #受信済みのデータに含まれるメッセージは待たずに続けて読めるため、まとめてキューに入る
+        try:
+            while True:
+                r_dict, is_binary = await read_message(reader, self.max_frame_sz_)
+                if r_dict is None:
+                    print('[des]Disconnected from client({0}).'.format(addr))
+                    break
+                if len(r_dict.keys()) != 0:
+                    await queue.put((r_dict, is_binary))
+        except (ConnectionResetError, BrokenPipeError):
+            print('[des]Disconnected from client({0}).'.format(addr))
+        except ProtocolError as e:
+            print('[des]Invalid message from client({0}): {1}'.format(addr, e))
+        finally:
             try:
-                conn, addr = self.server_.accept()
-                print('[des]Connected from {0}.'.format(addr))
-                th = threading.Thread(target=self.on_process_, args=[conn, addr])
-                th.setDaemon(True)
-                th.start()
-
-            except socket.timeout:
-                print('[des]Waiting a host...')
-            except KeyboardInterrupt:
-                break
-
-    def on_process_(self, conn, addr):
-        self.obj_left_.change_mode(0)
-        self.obj_right_.change_mode(0)
-
-        while True:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                #キューが一杯の場合は、処理側がキューを空にした後に終了を伝える
+                self.loop_.create_task(queue.put(None))
+
+    async def process_batch_(self, batch, session, addr):
+        #瞳の位置・瞬き・表情モードは顔ごとに最新の値だけを反映し、それ以外のメッセージは順番に処理する
+        #(画像の登録より後に送られた表情モードが先に反映されないよう、途中で溜めた値を先に反映する)
+        resp_extra = {}
+        pending = {}
+        face_id = None
+        for r_dict, _ in batch:
             try:
-                r_dict = receive(conn)
+                face_id = await self.process_message_(r_dict, session, addr, resp_extra, pending)
+            except (KeyError, IndexError, TypeError, ValueError, OverflowError) as e:
+                #不正な値を含むメッセージはProtocolErrorとして扱い、この接続だけを閉じる
+                raise ProtocolError('invalid message: {0!r}'.format(e)) from e
+        self.publish_pending_(pending)
 
-                if len(r_dict.keys()) != 0:
-                    self.mutex_.acquire()
-
-                    if Key().data_id in r_dict:
-                        self.resp_packets_[Key().data_id] = r_dict[Key().data_id]
-                        self.resp_packets_[Key().mode_num] = self.obj_right_.numof_mode()
-
-                    if Key().y_pos in r_dict and Key().x_pos in r_dict:
-                        self.packets[Key().y_pos] = r_dict[Key().y_pos]
-                        self.packets[Key().x_pos] = r_dict[Key().x_pos]
-                        self.set_pos_()
-
-                    if Key().blink_period in r_dict and Key().blink_num in r_dict:
-                        self.packets[Key().blink_period] = r_dict[Key().blink_period]
-                        self.packets[Key().blink_num] = r_dict[Key().blink_num]
-                        self.set_interval_()
-
-                    if Key().right_mode in r_dict and Key().left_mode in r_dict:
-                        self.packets[Key().right_mode] = r_dict[Key().right_mode]
-                        self.packets[Key().left_mode] = r_dict[Key().left_mode]
-                        self.set_mode_()
-
-                    if Key().right_mode_img in r_dict and Key().left_mode_img in r_dict:
-                        self.packets[Key().right_mode_img] = r_dict[Key().right_mode_img]
-                        self.packets[Key().left_mode_img] = r_dict[Key().left_mode_img]
-                        self.packets[Key().mode_id] = r_dict[Key().mode_id]
-                        self.add_mode_(False)
-
-                    if Key().rl_mode_img in r_dict:
-                        self.packets[Key().rl_mode_img] = r_dict[Key().rl_mode_img]
-                        self.packets[Key().mode_id] = r_dict[Key().mode_id]
-                        self.add_mode_(True)
-
-                    self.mutex_.release()
-                    send(conn, self.resp_packets_)
-                    print('Data received from {0}.\n  keys: {1}\n'.format(addr, r_dict.keys()))
-            except ConnectionResetError:
-                print('[des]Disconnected from client({0}).'.format(addr))
-                break
-
-            if self._is_alive_ == False:
-                break
-
-        print('Close connection.')
-        conn.shutdown(socket.SHUT_RDWR)
-        conn.close()
+        resp_packets = session.resp_packets
+        if face_id is not None:
+            resp_packets[Key().mode_num] = len(self.faces_[face_id].state_.right_modes)
+        else:
+            resp_packets[Key().mode_num] = 0
+
+        if len(batch) == 1:
+            print('Data received from {0}.\n  keys: {1}\n'.format(addr, batch[0][0].keys()))
+        else:
+            print('Data received from {0}.\n  {1} messages, last keys: {2}\n'.format(addr, len(batch), batch[-1][0].keys()))
+        return dict(resp_packets, **resp_extra)
+
+    async def process_message_(self, r_dict, session, addr, resp_extra, pending):
+        #メッセージを1つ処理して顔IDを返す(不正な値を含む場合は例外を返す)
+        fields = self.state_fields_(r_dict)
+        if fields is None:
+            self.publish_pending_(pending)
+            if self.is_heavy_(r_dict):
+                #画像のハッシュ値の計算・デコード・拡大はイベントループの外で実行する
+                return await self.loop_.run_in_executor(None, self.process_packets_, r_dict, session, addr, resp_extra)
+            return self.process_packets_(r_dict, session, addr, resp_extra)
+
+        face_id = self.select_face_(r_dict, session, addr, pending)
+        if face_id is not None:
+            #更新した項目は末尾に並べ直し、公開時に受信した順で反映されるようにする
+            #(表情モードの変更は瞳の位置を中心に戻すため、その後に届いた位置を失わないように)
+            face_fields = pending.setdefault(face_id, {})
+            for name, value in fields.items():
+                face_fields.pop(name, None)
+                face_fields[name] = value
+        if Key().data_id in r_dict:
+            session.resp_packets[Key().data_id] = r_dict[Key().data_id]
+        return face_id
+
+    def state_fields_(self, r_dict):
+        #最新の値だけを反映すればよいメッセージ(瞳の位置・瞬き・表情モードのみ)であれば、
+        #スナップショットの項目の辞書を返す(それ以外を含む場合はNone)
+        keys = {Key().data_id, Key().face_id,
+                Key().y_pos, Key().x_pos, Key().blink_period, Key().blink_num, Key().right_mode, Key().left_mode}
+        if any(key not in keys for key in r_dict):
+            return None
+        return self.state_values_(r_dict)
+
+    def state_values_(self, r_dict):
+        #メッセージに含まれる瞳の位置・瞬き・表情モードを確かめ、スナップショットの項目の辞書を返す
+        #(描画スレッドで例外にならないよう、型・範囲の誤った値は反映せずにProtocolErrorを返す)
+        fields = {}
+        if Key().y_pos in r_dict and Key().x_pos in r_dict:
+            y, x = r_dict[Key().y_pos], r_dict[Key().x_pos]
+            if not (is_finite_(y) and is_finite_(x)):
+                raise ProtocolError('invalid position: ({0!r}, {1!r})'.format(y, x))
+            fields['pos'] = (float(y), float(x))
+        if Key().blink_period in r_dict and Key().blink_num in r_dict:
+            period, num = r_dict[Key().blink_period], r_dict[Key().blink_num]
+            if not (is_finite_(period) and period >= 0 and is_count_(num)):
+                raise ProtocolError('invalid blink: ({0!r}, {1!r})'.format(period, num))
+            fields['blink'] = (float(period), int(num))
+        if Key().right_mode in r_dict and Key().left_mode in r_dict:
+            rmode, lmode = r_dict[Key().right_mode], r_dict[Key().left_mode]
+            if not (is_count_(rmode) and is_count_(lmode)):
+                raise ProtocolError('invalid mode: ({0!r}, {1!r})'.format(rmode, lmode))
+            fields['mode'] = (int(rmode), int(lmode))
+        return fields
+
+    def publish_pending_(self, pending):
+        #顔ごとに溜めた最新の値を1回ずつ公開する
+        for face_id, fields in pending.items():
+            self.publish_(face_id, **fields)
+        pending.clear()
+
+    def select_face_(self, r_dict, session, addr, pending=None):
+        #メッセージの顔IDを確かめ、接続後に最初に制御された顔は表情モードを初期化する
+        #(pendingを指定した場合は、初期化も溜めた値として後から反映する)
+        face_id = r_dict.get(Key().face_id, 0)
+        if not is_int_(face_id):
+            raise ProtocolError('invalid face id: {0!r}'.format(face_id))
+        if not (0 <= face_id < len(self.faces_)):
+            print('[des]Unknown face id {0} from {1}.'.format(face_id, addr))
+            return None
+        if face_id not in session.reset_faces:
+            if pending is None:
+                self.publish_(face_id, mode=(0, 0))
+            else:
+                pending.setdefault(face_id, {})['mode'] = (0, 0)
+            session.reset_faces.add(face_id)
+        return face_id
+
+    def is_heavy_(self, r_dict):
+        return (Key().asset_chunk in r_dict or Key().rl_mode_img in r_dict or
+                Key().right_mode_img in r_dict or Key().left_mode_img in r_dict)
+
+    def process_packets_(self, r_dict, session, addr, resp_extra):
+        #受信したメッセージを反映し、応答に加える項目をresp_extraに書き込んで顔IDを返す
+        if Key().proto_ver in r_dict:
+            #クライアントと共通のバージョンを返す(以降はクライアントが選んだ形式で応答する)
+            resp_extra[Key().proto_ver] = min(int(r_dict[Key().proto_ver]), WIRE_VERSION)
+        if Key().asset_chunk in r_dict:
+            self.receive_chunk_(r_dict[Key().asset_chunk], session.uploads)
+        if Key().asset_query in r_dict:
+            resp_extra[Key().asset_missing] = self.find_missing_(r_dict[Key().asset_query])
+
+        face_id = self.select_face_(r_dict, session, addr)
+        if face_id is not None:
+            missing = []
+            self.apply_packets_(r_dict, face_id, missing)
+            if len(missing) != 0:
+                #送信済みの画像が素材ストアから削除されていた場合は、クライアントが送り直せるように応答で知らせる
+                resp_missing = resp_extra.setdefault(Key().asset_missing, [])
+                resp_missing.extend(digest for digest in missing if digest not in resp_missing)
+
+        if Key().data_id in r_dict:
+            session.resp_packets[Key().data_id] = r_dict[Key().data_id]
+
+        if r_dict.get(Key().stats, False):
+            resp_extra[Key().stats] = self.get_stats()
+        return face_id
+
+    def apply_packets_(self, r_dict, face_id, missing=None):
+        for name, value in self.state_values_(r_dict).items():
+            self.publish_(face_id, **{name: value})
+
+        if Key().right_mode_img in r_dict and Key().left_mode_img in r_dict:
+            self.add_mode_(r_dict, False, face_id, missing)
+
+        if Key().rl_mode_img in r_dict:
+            self.add_mode_(r_dict, True, face_id, missing)
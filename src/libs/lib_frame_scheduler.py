@@ -0,0 +1,168 @@
+'''
+フレームスケジューラ ライブラリ
+
+描画ループを一定のフレームレートで回すためのクラスを定義してある。
+次のフレームの締め切り時刻まで待機し、処理が遅れて締め切りを過ぎたフレームは
+描画せずに読み飛ばすことで、時刻がずれていかないようにする。
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import time
+import math
+
+#一定周期でフレームの締め切り時刻を管理するクラス
+class FrameScheduler:
+
+    def __init__(self, fps=30.0):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        fps     : float
+            目標のフレームレート[fps](0以下で待機せずに最大速度で回す)
+        '''
+
+        self.set_fps(fps)
+        self.reset()
+
+    def set_fps(self, fps):
+        '''
+        目標のフレームレートを変更する関数
+
+        Parameters
+        ----------
+        fps     : float
+            目標のフレームレート[fps](0以下で待機せずに最大速度で回す)
+
+        Returns
+        -------
+        None
+        '''
+
+        self.fps_ = fps
+        self.period_ = 1.0 / fps if fps > 0 else 0.0
+
+    def reset(self):
+        '''
+        締め切り時刻と統計情報を初期化する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+
+        self.next_t_ = None
+        self.start_t_ = None
+
+        self.frame_cnt_ = 0
+        self.missed_cnt_ = 0
+        self.skipped_cnt_ = 0
+
+        self.jitter_sum_ = 0.0
+        self.jitter_sq_sum_ = 0.0
+        self.jitter_max_ = 0.0
+
+    def wait(self):
+        '''
+        次のフレームの締め切り時刻まで待機する関数
+
+        締め切りを1周期以上過ぎていた場合は、過ぎたフレームを読み飛ばして
+        次の締め切り時刻に合わせる。
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        t       : float
+            待機を終えた時刻(time.monotonic()基準)[sec]
+        '''
+
+        now = time.monotonic()
+        if self.next_t_ is None:
+            self.next_t_ = now
+            self.start_t_ = now
+
+        late = now - self.next_t_
+        if self.period_ == 0.0:
+            #フレームレートの制限なし
+            self.next_t_ = now
+        elif late >= self.period_:
+            #間に合わなかったフレームは描画せずに締め切りだけ進める
+            missed = int(math.floor(late / self.period_))
+            self.missed_cnt_ += missed
+            self.next_t_ += missed * self.period_
+        elif late < 0:
+            time.sleep(-late)
+
+        t = time.monotonic()
+        jitter = t - self.next_t_
+        self.jitter_sum_ += jitter
+        self.jitter_sq_sum_ += jitter * jitter
+        self.jitter_max_ = max(self.jitter_max_, jitter)
+        self.frame_cnt_ += 1
+
+        self.next_t_ += self.period_
+        return t
+
+    def skip(self):
+        '''
+        待機したフレームを描画しなかったことを記録する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+
+        self.skipped_cnt_ += 1
+
+    def get_stats(self):
+        '''
+        フレームの周期の統計情報を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            fps         : 目標のフレームレート[fps]
+            actual-fps  : 実際に描画したフレームレート[fps]
+            frames      : 待機したフレーム数
+            missed      : 締め切りに間に合わず読み飛ばしたフレーム数
+            skipped     : 待機後に描画しなかったフレーム数
+            jitter-mean : 締め切りからの遅れの平均[sec]
+            jitter-std  : 締め切りからの遅れの標準偏差[sec]
+            jitter-max  : 締め切りからの遅れの最大値[sec]
+        '''
+
+        n = self.frame_cnt_
+        mean = self.jitter_sum_ / n if n > 0 else 0.0
+        var = self.jitter_sq_sum_ / n - mean * mean if n > 0 else 0.0
+
+        elapsed = time.monotonic() - self.start_t_ if self.start_t_ is not None else 0.0
+        drawn = n - self.skipped_cnt_
+
+        return {
+            'fps'           : self.fps_,
+            'actual-fps'    : drawn / elapsed if elapsed > 0 else 0.0,
+            'frames'        : n,
+            'missed'        : self.missed_cnt_,
+            'skipped'       : self.skipped_cnt_,
+            'jitter-mean'   : mean,
+            'jitter-std'    : math.sqrt(max(var, 0.0)),
+            'jitter-max'    : self.jitter_max_
+        }
@@ -0,0 +1,227 @@
+'''
+フレーム出力先 ライブラリ
+
+描画した眼の画像の出力先(シンク)を定義してある。
+ウィンドウ表示の他に、画面のない環境で描画ループを動かすための
+破棄(null)、生データのファイル(またはパイプ)書き出し、共有メモリのリングバッファを用意している。
+
+どのシンクも次の関数を持つ。
+    write(frame)    : 1フレームを出力する
+    poll()          : 出力を続ける場合True、終了する場合Falseを返す
+    close()         : 出力先を閉じる
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import struct
+
+import cv2
+import numpy as np
+
+from multiprocessing import shared_memory, resource_tracker
+
+#ウィンドウに表示するシンク
+class WindowSink:
+
+    def __init__(self, name='eyes_test', fullscreen=True):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        name        : string
+            ウィンドウ名
+
+        fullscreen  : bool
+            フルスクリーンで表示するかどうか
+        '''
+
+        self.name_ = name
+        if fullscreen:
+            cv2.namedWindow(self.name_, cv2.WND_PROP_FULLSCREEN)
+            cv2.setWindowProperty(self.name_, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        else:
+            cv2.namedWindow(self.name_)
+
+    def write(self, frame):
+        cv2.imshow(self.name_, frame)
+
+    def poll(self):
+        #'q'キーが押されたら終了する
+        return not (cv2.waitKey(1) & 0xFF == ord('q'))
+
+    def close(self):
+        cv2.destroyWindow(self.name_)
+
+#画像を破棄するシンク(ベンチマーク用)
+class NullSink:
+
+    def __init__(self):
+        '''
+        クラスコンストラクタ
+        '''
+
+        self.frame_cnt = 0
+
+    def write(self, frame):
+        self.frame_cnt += 1
+
+    def poll(self):
+        return True
+
+    def close(self):
+        pass
+
+#画像の生データ(BGR, 1画素3バイト)をファイル(または名前付きパイプ)に書き出すシンク
+class RawFileSink:
+
+    def __init__(self, path):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        path    : string
+            書き出し先のファイルパス(名前付きパイプも指定できる)
+            例 : ffmpeg -f rawvideo -pix_fmt bgr24 -s 2580x720 -i (path) ...
+        '''
+
+        self.f_ = open(path, 'wb')
+        self.is_open_ = True
+
+    def write(self, frame):
+        if not self.is_open_:
+            return
+        try:
+            self.f_.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            #読み出し側が閉じられた
+            self.is_open_ = False
+
+    def poll(self):
+        return self.is_open_
+
+    def close(self):
+        try:
+            self.f_.close()
+        except BrokenPipeError:
+            pass
+
+#共有メモリのヘッダ(識別子, スロット数, 高さ, 幅, チャンネル数, 書き込み済みフレーム数)
+SHM_MAGIC = b'DMEYSHM1'
+SHM_HEADER = struct.Struct('<8sIIIIQ')
+#各スロットの先頭に置くフレーム番号(書き込み中は0)
+SHM_SLOT_HEADER = struct.Struct('<Q')
+
+#共有メモリ上のリングバッファに書き込むシンク
+class ShmRingSink:
+
+    def __init__(self, name, shape, slots=4):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        name    : string
+            共有メモリの名前
+
+        shape   : (int, int, int)
+            画像の大きさ(高さ, 幅, チャンネル数)
+
+        slots   : int
+            リングバッファのスロット数
+        '''
+
+        self.shape_ = tuple(shape)
+        self.slots_ = slots
+        self.frame_sz_ = int(np.prod(self.shape_))
+        self.slot_sz_ = SHM_SLOT_HEADER.size + self.frame_sz_
+
+        self.shm_ = shared_memory.SharedMemory(name=name, create=True,
+                                               size=SHM_HEADER.size + self.slot_sz_*slots)
+        self.frame_cnt_ = 0
+        self.write_header_()
+
+    def write(self, frame):
+        slot_ofs = SHM_HEADER.size + (self.frame_cnt_ % self.slots_)*self.slot_sz_
+        data_ofs = slot_ofs + SHM_SLOT_HEADER.size
+
+        #書き込み中であることを示してからデータを書き込み、最後にフレーム番号を入れる
+        SHM_SLOT_HEADER.pack_into(self.shm_.buf, slot_ofs, 0)
+        dst = np.ndarray(self.shape_, dtype=np.uint8, buffer=self.shm_.buf, offset=data_ofs)
+        np.copyto(dst, frame)
+        del dst
+
+        self.frame_cnt_ += 1
+        SHM_SLOT_HEADER.pack_into(self.shm_.buf, slot_ofs, self.frame_cnt_)
+        self.write_header_()
+
+    def poll(self):
+        return True
+
+    def close(self):
+        self.shm_.close()
+        self.shm_.unlink()
+
+    def write_header_(self):
+        SHM_HEADER.pack_into(self.shm_.buf, 0, SHM_MAGIC, self.slots_,
+                             self.shape_[0], self.shape_[1], self.shape_[2], self.frame_cnt_)
+
+#ShmRingSinkが書き込んだ共有メモリから画像を読み出すクラス
+class ShmRingReader:
+
+    def __init__(self, name):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        name    : string
+            共有メモリの名前
+        '''
+
+        self.shm_ = shared_memory.SharedMemory(name=name)
+        #読み出し側の終了時に共有メモリが削除されないようにする
+        resource_tracker.unregister(self.shm_._name, 'shared_memory')
+
+        magic, self.slots_, h, w, c, _ = SHM_HEADER.unpack_from(self.shm_.buf, 0)
+        if magic != SHM_MAGIC:
+            raise ValueError("Not a frame ring buffer: {0}".format(name))
+        self.shape_ = (h, w, c)
+        self.slot_sz_ = SHM_SLOT_HEADER.size + h*w*c
+
+    def read_latest(self):
+        '''
+        最後に書き込まれた画像を読み出す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        frame_no    : int
+            フレーム番号(1から始まる), まだ書き込まれていない場合0
+
+        frame       : ndarray or None
+            画像のコピー。読み出し中に上書きされた場合はNone
+        '''
+
+        frame_no = SHM_HEADER.unpack_from(self.shm_.buf, 0)[5]
+        if frame_no == 0:
+            return (0, None)
+
+        slot_ofs = SHM_HEADER.size + ((frame_no-1) % self.slots_)*self.slot_sz_
+        src = np.ndarray(self.shape_, dtype=np.uint8, buffer=self.shm_.buf,
+                         offset=slot_ofs + SHM_SLOT_HEADER.size)
+        frame = src.copy()
+        del src
+
+        #コピーした後もスロットのフレーム番号が変わっていなければ有効
+        if SHM_SLOT_HEADER.unpack_from(self.shm_.buf, slot_ofs)[0] != frame_no:
+            return (frame_no, None)
+        return (frame_no, frame)
+
+    def close(self):
+        self.shm_.close()
@@ -0,0 +1,118 @@
+'''
+フレーム処理時間の計測 ライブラリ
+
+描画の各段階(右目, 左目, まぶた, 拡大, 表示など)の処理時間を記録し、
+直近の一定数のフレームについてのヒストグラムとパーセンタイルを求めるクラスを定義してある。
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import threading
+
+import numpy as np
+
+#ヒストグラムの区間の境界[sec](10us〜1sを対数で区切る)
+HIST_EDGES = np.concatenate(([0.0], np.logspace(-5, 0, 11), [np.inf]))
+
+#各段階の処理時間を直近window個まで保持するクラス
+class FrameStats:
+
+    def __init__(self, window=300):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        window  : int
+            統計に使う直近のサンプル数
+        '''
+
+        self.window_ = window
+        self.samples_ = {}
+        self.counts_ = {}
+        self.mutex_ = threading.Lock()
+
+    def record(self, stage, sec):
+        '''
+        処理時間を記録する関数
+
+        Parameters
+        ----------
+        stage   : string
+            段階の名前
+
+        sec     : float
+            処理時間[sec]
+
+        Returns
+        -------
+        None
+        '''
+
+        samples = self.samples_.get(stage)
+        if samples is None:
+            with self.mutex_:
+                samples = self.samples_.setdefault(stage, np.zeros(self.window_))
+                self.counts_.setdefault(stage, 0)
+
+        cnt = self.counts_[stage]
+        samples[cnt % self.window_] = sec
+        self.counts_[stage] = cnt + 1
+
+    def get_stats(self):
+        '''
+        各段階の処理時間の統計を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stats   : dict
+            段階の名前をキーとする辞書。各値は次のキーを持つ辞書
+            count   : 記録された総数
+            mean    : 直近の平均[sec]
+            p50, p90, p99 : 直近のパーセンタイル[sec]
+            max     : 直近の最大値[sec]
+            hist    : 直近のヒストグラム(HIST_EDGESの区間ごとの個数のリスト)
+        '''
+
+        with self.mutex_:
+            stages = list(self.samples_.items())
+
+        stats = {}
+        for stage, samples in stages:
+            cnt = self.counts_[stage]
+            if cnt == 0:
+                continue
+            recent = samples[:min(cnt, self.window_)].copy()
+            p50, p90, p99 = np.percentile(recent, [50, 90, 99])
+            stats[stage] = {
+                'count' : cnt,
+                'mean'  : float(recent.mean()),
+                'p50'   : float(p50),
+                'p90'   : float(p90),
+                'p99'   : float(p99),
+                'max'   : float(recent.max()),
+                'hist'  : np.histogram(recent, HIST_EDGES)[0].tolist()
+            }
+
+        return stats
+
+    def get_hist_edges(self):
+        '''
+        ヒストグラムの区間の境界を返す関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        edges   : [float, ...]
+            区間の境界[sec](最後は無限大)
+        '''
+
+        return HIST_EDGES.tolist()
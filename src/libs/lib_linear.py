@@ -4,20 +4,22 @@
 眼を線形的に動かしたいときに便利な関数を提供するライブラリ。
 使い方はtest_smooth_perspective.pyを参照。
 現在、比例関数(Proportion)、3次関数(Pow3)が使用できる。
+時刻はコンストラクタのclockに渡した時計(省略時は共通の時計)から取得する。
 
 '''
 
-import time
+from .lib_clock import get_default_clock
 
 class Proportion:
-    def __init__(self, y0=0):
+    def __init__(self, y0=0, clock=None):
+        self.clock = clock if clock is not None else get_default_clock()
         self.T = 0
         self.A = 0
         self.B = y0
-        self.t0 = time.time()
+        self.t0 = self.clock.time()
 
     def reset(self, y1, dt):
-        t = time.time() - self.t0
+        t = self.clock.time() - self.t0
         if t > self.T:
             y0 = self.get_out()[0]
             if dt == 0:
@@ -25,27 +27,28 @@ class Proportion:
             self.T = dt
             self.A = (y1 - y0) / dt
             self.B = y0
-            self.t0 = time.time()
+            self.t0 = self.clock.time()
             return True
         else:
             return False
 
     def get_out(self):
-        t = time.time() - self.t0
+        t = self.clock.time() - self.t0
         if self.T >= t:
             return (self.A * t + self.B, False)
         else:
             return (self.A * self.T + self.B, True)
 
 class Pow3:
-    def __init__(self, y0=0):
+    def __init__(self, y0=0, clock=None):
+        self.clock = clock if clock is not None else get_default_clock()
         self.T = 0
         self.A = 0
         self.B = y0
-        self.t0 = time.time()
+        self.t0 = self.clock.time()
 
     def reset(self, y1, dt):
-        t = time.time() - self.t0
+        t = self.clock.time() - self.t0
         if t > self.T:
             y0 = self.get_out()[0]
             if dt == 0:
@@ -53,13 +56,13 @@ class Pow3:
             self.T = dt
             self.A = (y1 - y0) / (dt*dt*dt)
             self.B = y0
-            self.t0 = time.time()
+            self.t0 = self.clock.time()
             return True
         else:
             return False
 
     def get_out(self):
-        t = time.time() - self.t0
+        t = self.clock.time() - self.t0
         if self.T >= t:
             return (self.A * t*t*t + self.B, False)
         else:
@@ -3,41 +3,635 @@ TCP方式(同期通信)用可変長データ送受信プロトコル
 
 同期通信で使用する通信処理。最初に固定長のデータ長パケット送信後に
 可変長のペイロードパケットを送信する方式。
+(asyncioで通信するサーバー用に、同じ形式をストリームから受信する関数(read_message)も定義してある)
+
+高頻度で送る瞳の座標は、TCPとは別にUDPのデータグラム(1つで完結する固定長のパケット)でも送信できる。
+    識別子, 種類, 顔ID, 通し番号, 値(2つ)  : >2sBBIdd
+受信側は送信元と顔IDごとに通し番号を記録し、それより古い(順番が入れ替わった)データグラムを破棄する。
+
+ペイロードの形式は次の2種類で、先頭の識別子で区別する。
+    バイナリ形式(バージョン2)   : 識別子, バージョン, レコード数の後に、コマンドごとのレコードを並べる
+                                  (瞳の座標・瞬き・表情モードは固定長、画像は長さ付きのバイト列)
+    pickle形式(バージョン1)     : 従来のpickle(プロトコル0)。受信時は辞書と基本的な型以外を復元しない
+接続直後はpickle形式で送信し、相手から'proto-ver'に2以上が返された場合のみバイナリ形式に切り替える。
 
 author  : Taiyou Komazawa
 date    : 2022/11/21
 '''
 
+import io
 import struct
 import pickle
+import asyncio
+
+from .donmas_eye_server_keys import HeaderKey as Key
 
 payload_size = struct.calcsize('>L')
 
+#受信できるメッセージの大きさの既定の上限[bytes]
+#(古いクライアントは画像をpickle形式で分割せずに送るため、画像の上限(64MB)より余裕を持たせる)
+MAX_FRAME_SIZE = 256*1024*1024
 
-def send(conn, packets):
-    serial_packets = pickle.dumps(packets, 0)
-    data = struct.pack('>L', len(serial_packets)) + serial_packets
-    result = conn.send(data)
-    return result
+#バイナリ形式の識別子とバージョン(pickleのプロトコル0は'('などのASCII文字で始まるため区別できる)
+WIRE_MAGIC = b'\xd3E'
+WIRE_VERSION = 2
 
-def receive(conn, max_buffer_sz=1024):
-    r_dict = {}
+#ペイロードの先頭(識別子, バージョン, レコード数)
+WIRE_HEADER = struct.Struct('>2sBH')
+
+#レコードの種類
+TAG_DATA_ID     = 0x01  #データID                   : >q
+TAG_POS         = 0x02  #瞳の座標(x, y)             : >dd
+TAG_BLINK       = 0x03  #瞬きの(間隔, 回数)         : >di
+TAG_MODE        = 0x04  #表情モード(右, 左)         : >ii
+TAG_FACE_ID     = 0x05  #顔ID                       : >i
+TAG_MODE_ID     = 0x06  #追加する表情モードのID     : >i
+TAG_MODE_NUM    = 0x07  #表情モードの数             : >i
+TAG_IMAGE       = 0x08  #画像パケット               : 種類(B), ファイル名, ハッシュ値, バイト列
+TAG_CHUNK       = 0x09  #画像の分割パケット         : ハッシュ値, ファイル名, 位置(>Q), 全体の大きさ(>Q), バイト列
+TAG_QUERY       = 0x0a  #問い合わせるハッシュ値     : 個数(>H), ハッシュ値の列
+TAG_MISSING     = 0x0b  #サーバーに無いハッシュ値   : 個数(>H), ハッシュ値の列
+TAG_VALUE       = 0x0f  #その他の値                 : キー(文字列), 型付きの値
+
+key_ = Key()
+
+#UDPのデータグラム(識別子, 種類, 顔ID, 通し番号, 値(2つ))
+DATAGRAM = struct.Struct('>2sBBIdd')
+#データグラムの種類
+DGRAM_POS       = 0x01  #瞳の座標(x, y)
+
+#固定長のレコード(種類 -> (構造体, キーのリスト))
+FIXED_RECORDS = {
+    TAG_DATA_ID     : (struct.Struct('>q'),  [key_.data_id]),
+    TAG_POS         : (struct.Struct('>dd'), [key_.x_pos, key_.y_pos]),
+    TAG_BLINK       : (struct.Struct('>di'), [key_.blink_period, key_.blink_num]),
+    TAG_MODE        : (struct.Struct('>ii'), [key_.right_mode, key_.left_mode]),
+    TAG_FACE_ID     : (struct.Struct('>i'),  [key_.face_id]),
+    TAG_MODE_ID     : (struct.Struct('>i'),  [key_.mode_id]),
+    TAG_MODE_NUM    : (struct.Struct('>i'),  [key_.mode_num])
+}
+#固定長のレコードの前に付ける種類(1byte)
+FIXED_TAGS = {tag : bytes([tag]) for tag in FIXED_RECORDS}
+
+#画像パケットの種類
+IMAGE_SLOTS = [key_.rl_mode_img, key_.right_mode_img, key_.left_mode_img]
+
+HASH_SIZE = 32
+
+#型付きの値で入れ子にできるリスト・辞書の深さの上限
+MAX_VALUE_DEPTH = 32
+
+U8 = struct.Struct('>B')
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>L')
+U64 = struct.Struct('>Q')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+#pickle形式の受信で復元を許可するクラス(プロトコル0のバイト列とnumpyのスカラー値)
+SAFE_PICKLE_GLOBALS = {
+    ('_codecs', 'encode'),
+    ('builtins', 'bytes'),
+    ('builtins', 'bytearray'),
+    ('numpy', 'dtype'),
+    ('numpy.core.multiarray', 'scalar'),
+    ('numpy._core.multiarray', 'scalar')
+}
 
-    packed_msg_sz = conn.recv(payload_size)
+#受信したメッセージを復元できなかった場合の例外
+class ProtocolError(Exception):
+    pass
 
-    if len(packed_msg_sz) >= 4:
-        msg_sz = struct.unpack('>L', packed_msg_sz)[0]
+#許可したクラス以外を復元しないpickleの読み込みクラス
+class SafeUnpickler(pickle.Unpickler):
 
-        data = b''
-        if msg_sz <= max_buffer_sz:
-            data = conn.recv(msg_sz)
+    def find_class(self, module, name):
+        if (module, name) not in SAFE_PICKLE_GLOBALS:
+            raise pickle.UnpicklingError("Forbidden global in packet: {0}.{1}".format(module, name))
+        return super().find_class(module, name)
+
+def safe_loads(data):
+    return SafeUnpickler(io.BytesIO(data), fix_imports=True, encoding='bytes').load()
+
+def send(conn, packets, binary=False):
+    data = frame_message(packets, binary)
+    #sendは一部しか送信しないことがあるため、全て送信し終えるまで待つ
+    conn.sendall(data)
+    return len(data)
+
+def frame_message(packets, binary=False):
+    '''
+    メッセージをデータ長付きのバイト列に変換する関数
+
+    Parameters
+    ----------
+    packets : dict
+        送信するメッセージ
+
+    binary  : bool
+        バイナリ形式で送信する場合True(Falseの場合はpickle形式)
+
+    Returns
+    -------
+    data    : bytes
+        データ長とペイロードをつなげたバイト列
+    '''
+
+    if binary:
+        serial_packets = encode_packets(packets)
+    else:
+        serial_packets = pickle.dumps(packets, 0)
+    return struct.pack('>L', len(serial_packets)) + serial_packets
+
+def parse_message(data):
+    '''
+    受信したペイロードを辞書に変換する関数(形式は先頭の識別子で判別する)
+    (メッセージを復元できなかった場合(許可されていないクラスを含むpickleなど)はProtocolErrorを送出する)
+
+    Parameters
+    ----------
+    data    : bytes or memoryview
+        受信したペイロード
+
+    Returns
+    -------
+    r_dict      : dict
+        受信したメッセージ
+
+    is_binary   : bool
+        バイナリ形式で受信した場合True
+    '''
+
+    is_binary = data[:len(WIRE_MAGIC)] == WIRE_MAGIC
+    try:
+        if is_binary:
+            r_dict = decode_packets(data)
         else:
-            buff_sz = msg_sz
-            while buff_sz > max_buffer_sz:
-                data += conn.recv(max_buffer_sz)
-                buff_sz -= max_buffer_sz
-            data += conn.recv(buff_sz)
+            r_dict = safe_loads(data)
+    except (pickle.UnpicklingError, ValueError, TypeError, IndexError, EOFError, RecursionError, struct.error) as e:
+        raise ProtocolError("Malformed message: {0}".format(e)) from e
+
+    if type(r_dict) is not dict:
+        raise ProtocolError("Message is not a dict: {0}".format(type(r_dict)))
+
+    return (r_dict, is_binary)
+
+async def read_message(reader, max_frame_sz=MAX_FRAME_SIZE):
+    '''
+    asyncioのストリームから1つのメッセージを受信する関数
+
+    Parameters
+    ----------
+    reader          : asyncio.StreamReader
+        受信するストリーム
+
+    max_frame_sz    : int
+        受信できるメッセージの最大の大きさ[bytes](超えた場合はProtocolErrorを送出する)
+
+    Returns
+    -------
+    r_dict      : dict or None
+        受信したメッセージ, メッセージの区切りで接続が閉じられた場合None
+
+    is_binary   : bool
+        バイナリ形式で受信した場合True
+    '''
+
+    try:
+        header = await reader.readexactly(payload_size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return (None, False)
+        raise ProtocolError("Connection closed in the middle of a message") from e
+
+    msg_sz, = struct.unpack('>L', header)
+    if msg_sz > max_frame_sz:
+        raise ProtocolError("Message too large: {0} > {1} bytes".format(msg_sz, max_frame_sz))
+
+    try:
+        data = await reader.readexactly(msg_sz)
+    except asyncio.IncompleteReadError as e:
+        raise ProtocolError("Connection closed in the middle of a message") from e
+
+    return parse_message(data)
+
+def pack_datagram(kind, face_id, seq, v0, v1):
+    '''
+    UDPで送信するデータグラムを作成する関数
+
+    Parameters
+    ----------
+    kind    : int
+        データグラムの種類(DGRAM_POS)
+
+    face_id : int
+        顔ID(0-255)
+
+    seq     : int
+        通し番号(32bitで一周する)
+
+    v0, v1  : float
+        値(DGRAM_POSの場合はx, y座標)
+
+    Returns
+    -------
+    data    : bytes
+        データグラム
+    '''
+
+    return DATAGRAM.pack(WIRE_MAGIC, kind, face_id, seq & 0xffffffff, v0, v1)
+
+def unpack_datagram(data):
+    '''
+    受信したデータグラムを復元する関数
+
+    Parameters
+    ----------
+    data    : bytes
+        受信したデータグラム
+
+    Returns
+    -------
+    dgram   : (int, int, int, float, float) or None
+        (種類, 顔ID, 通し番号, 値, 値), 形式が正しくない場合None
+    '''
+
+    if len(data) != DATAGRAM.size:
+        return None
+    magic, kind, face_id, seq, v0, v1 = DATAGRAM.unpack(data)
+    if magic != WIRE_MAGIC:
+        return None
+    return (kind, face_id, seq, v0, v1)
+
+def is_newer_seq(seq, last):
+    '''
+    通し番号がlastより新しいかどうかを返す関数(32bitで一周した場合も、差が半周未満であれば新しいとみなす)
+
+    Parameters
+    ----------
+    seq     : int
+        受信した通し番号
+
+    last    : int
+        最後に受け付けた通し番号
+
+    Returns
+    -------
+    rlt     : bool
+        新しい場合True
+    '''
+
+    return 0 < ((seq - last) & 0xffffffff) < 0x80000000
+
+def receive(conn, max_buffer_sz=1024):
+    r_dict, _ = receive_message(conn, max_buffer_sz)
+    return r_dict
+
+def receive_message(conn, max_buffer_sz=1024):
+    '''
+    1つのメッセージを受信する関数
+    (同じ接続で繰り返し受信する場合は、受信バッファを使い回すFrameReaderを使用する)
+
+    Parameters
+    ----------
+    conn            : socket.socket
+        受信するソケット
+
+    max_buffer_sz   : int
+        受信バッファの初期の大きさ[bytes]
+
+    Returns
+    -------
+    r_dict      : dict
+        受信したメッセージ(接続が閉じられた場合は空の辞書)
+
+    is_binary   : bool
+        バイナリ形式で受信した場合True
+    '''
+
+    r_dict, is_binary = FrameReader(conn, buffer_sz=max_buffer_sz).receive_message()
+    if r_dict is None:
+        return ({}, False)
+    return (r_dict, is_binary)
+
+#長さ付きのメッセージを、使い回す受信バッファに直接読み込むクラス
+class FrameReader:
+
+    def __init__(self, conn, max_frame_sz=MAX_FRAME_SIZE, buffer_sz=64*1024):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        conn            : socket.socket
+            受信するソケット
+
+        max_frame_sz    : int
+            受信できるメッセージの最大の大きさ[bytes](超えた場合はProtocolErrorを送出する)
+
+        buffer_sz       : int
+            受信バッファの初期の大きさ[bytes]
+            (より大きなメッセージを受信した場合は、max_frame_szを上限に拡張して以降も使い回す)
+        '''
+
+        self.conn_ = conn
+        self.max_frame_sz_ = max_frame_sz
+        self.header_ = bytearray(payload_size)
+        self.buffer_ = bytearray(max(1, min(buffer_sz, max_frame_sz)))
+
+    def read_frame(self):
+        '''
+        1つのメッセージのペイロードを受信する関数
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        payload : memoryview or None
+            受信したペイロード(受信バッファの一部であり、次の呼び出しで上書きされる)
+            メッセージの区切りで接続が閉じられた場合None
+            (メッセージの途中で閉じられた場合と、大きさが上限を超えた場合はProtocolErrorを送出する)
+        '''
+
+        if not self.recv_exact_(memoryview(self.header_), allow_eof=True):
+            return None
+
+        msg_sz, = struct.unpack('>L', self.header_)
+        if msg_sz > self.max_frame_sz_:
+            raise ProtocolError("Message too large: {0} > {1} bytes".format(msg_sz, self.max_frame_sz_))
+
+        if msg_sz > len(self.buffer_):
+            #大きなメッセージが続く場合に拡張を繰り返さないよう、倍々に拡張する
+            self.buffer_ = bytearray(min(max(msg_sz, 2*len(self.buffer_)), self.max_frame_sz_))
+
+        payload = memoryview(self.buffer_)[:msg_sz]
+        self.recv_exact_(payload, allow_eof=False)
+        return payload
+
+    def receive_message(self):
+        '''
+        1つのメッセージを受信して辞書に変換する関数
+        (メッセージを復元できなかった場合(許可されていないクラスを含むpickleなど)はProtocolErrorを送出する)
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        r_dict      : dict or None
+            受信したメッセージ, メッセージの区切りで接続が閉じられた場合None
+
+        is_binary   : bool
+            バイナリ形式で受信した場合True
+        '''
+
+        data = self.read_frame()
+        if data is None:
+            return (None, False)
+        return parse_message(data)
+
+    def recv_exact_(self, view, allow_eof):
+        #viewが埋まるまで受信する(recvは要求した大きさより少なく返すことがある)
+        got = 0
+        n = len(view)
+        while got < n:
+            r = self.conn_.recv_into(view[got:], n - got)
+            if r == 0:
+                if allow_eof and got == 0:
+                    return False
+                raise ProtocolError("Connection closed in the middle of a message")
+            got += r
+        return True
+
+def encode_packets(packets):
+    '''
+    辞書をバイナリ形式のペイロードに変換する関数
+
+    Parameters
+    ----------
+    packets : dict
+        送信するメッセージ(HeaderKeyのキーを持つ辞書)
 
-        r_dict = pickle.loads(data[:msg_sz], fix_imports=True, encoding='bytes')
+    Returns
+    -------
+    data    : bytes
+        バイナリ形式のペイロード
+    '''
+
+    key = key_
+    rest = dict(packets)
+    records = []
+
+    for tag, (fmt, keys) in FIXED_RECORDS.items():
+        #固定長のレコードのキーは2個以下
+        if keys[0] in rest and keys[-1] in rest:
+            try:
+                record = FIXED_TAGS[tag] + fmt.pack(*[rest[k] for k in keys])
+            except struct.error:
+                #固定長に収まらない値(整数の項目に小数が渡された場合など)は型付きの値として送る
+                continue
+            for k in keys:
+                del rest[k]
+            records.append(record)
+
+    if len(rest) == 0:
+        return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, len(records)) + b''.join(records)
+
+    for slot, k in enumerate(IMAGE_SLOTS):
+        f_data = rest.get(k)
+        if is_image_packet_(f_data):
+            del rest[k]
+            records.append(U8.pack(TAG_IMAGE) + U8.pack(slot) + encode_image_(f_data))
+
+    chunk = rest.get(key.asset_chunk)
+    if type(chunk) is dict and set(chunk.keys()) == {key.mode_hash, key.mode_fname, key.chunk_offset, key.asset_size, key.mode_bin}:
+        del rest[key.asset_chunk]
+        records.append(U8.pack(TAG_CHUNK) + bytes.fromhex(chunk[key.mode_hash]) +
+                       encode_str_(chunk[key.mode_fname]) +
+                       U64.pack(chunk[key.chunk_offset]) + U64.pack(chunk[key.asset_size]) +
+                       encode_blob_(chunk[key.mode_bin]))
+
+    for tag, k in ((TAG_QUERY, key.asset_query), (TAG_MISSING, key.asset_missing)):
+        if is_hash_list_(rest.get(k)):
+            digests = rest.pop(k)
+            records.append(U8.pack(tag) + U16.pack(len(digests)) + b''.join(bytes.fromhex(d) for d in digests))
+
+    for k, v in rest.items():
+        records.append(U8.pack(TAG_VALUE) + encode_value_(k) + encode_value_(v))
+
+    return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, len(records)) + b''.join(records)
+
+def decode_packets(data):
+    '''
+    バイナリ形式のペイロードを辞書に変換する関数
+
+    Parameters
+    ----------
+    data    : bytes or memoryview
+        バイナリ形式のペイロード(画像などのバイト列は複製して返すため、受信バッファは使い回してよい)
+
+    Returns
+    -------
+    r_dict  : dict
+        受信したメッセージ(HeaderKeyのキーを持つ辞書)
+    '''
+
+    key = key_
+    magic, version, num = WIRE_HEADER.unpack_from(data, 0)
+    if magic != WIRE_MAGIC or version != WIRE_VERSION:
+        raise ValueError("Unsupported wire format: {0!r} version {1}".format(magic, version))
+
+    r_dict = {}
+    ofs = WIRE_HEADER.size
+    for _ in range(num):
+        tag = data[ofs]
+        ofs += 1
+
+        if tag in FIXED_RECORDS:
+            fmt, keys = FIXED_RECORDS[tag]
+            r_dict.update(zip(keys, fmt.unpack_from(data, ofs)))
+            ofs += fmt.size
+        elif tag == TAG_IMAGE:
+            slot = data[ofs]
+            f_data, ofs = decode_image_(data, ofs + 1)
+            r_dict[IMAGE_SLOTS[slot]] = f_data
+        elif tag == TAG_CHUNK:
+            digest = data[ofs:ofs+HASH_SIZE].hex()
+            f_name, ofs = decode_str_(data, ofs + HASH_SIZE)
+            offset, = U64.unpack_from(data, ofs)
+            size, = U64.unpack_from(data, ofs + 8)
+            blob, ofs = decode_blob_(data, ofs + 16)
+            r_dict[key.asset_chunk] = {
+                key.mode_hash       : digest,
+                key.mode_fname      : f_name,
+                key.chunk_offset    : offset,
+                key.asset_size      : size,
+                key.mode_bin        : blob
+            }
+        elif tag == TAG_QUERY or tag == TAG_MISSING:
+            cnt, = U16.unpack_from(data, ofs)
+            ofs += U16.size
+            digests = [data[ofs+i*HASH_SIZE:ofs+(i+1)*HASH_SIZE].hex() for i in range(cnt)]
+            ofs += cnt*HASH_SIZE
+            r_dict[key.asset_query if tag == TAG_QUERY else key.asset_missing] = digests
+        elif tag == TAG_VALUE:
+            k, ofs = decode_value_(data, ofs)
+            v, ofs = decode_value_(data, ofs)
+            r_dict[k] = v
+        else:
+            raise ValueError("Unknown record tag: {0}".format(tag))
 
     return r_dict
+
+def is_hash_(digest):
+    return type(digest) is str and len(digest) == 2*HASH_SIZE and all(c in '0123456789abcdef' for c in digest)
+
+def is_hash_list_(digests):
+    return type(digests) is list and len(digests) < 0x10000 and all(is_hash_(d) for d in digests)
+
+def is_image_packet_(f_data):
+    #ファイル名と、バイト列またはハッシュ値のどちらか一方を持つ画像パケットのみ固定の形式で送る
+    key = key_
+    if type(f_data) is not dict or type(f_data.get(key.mode_fname)) is not str:
+        return False
+    keys = set(f_data.keys())
+    if keys == {key.mode_fname, key.mode_bin}:
+        return type(f_data[key.mode_bin]) is bytes
+    if keys == {key.mode_fname, key.mode_hash}:
+        return is_hash_(f_data[key.mode_hash])
+    return False
+
+def encode_image_(f_data):
+    key = key_
+    if key.mode_hash in f_data:
+        return encode_str_(f_data[key.mode_fname]) + bytes.fromhex(f_data[key.mode_hash])
+    return encode_str_(f_data[key.mode_fname]) + b'\x00'*HASH_SIZE + encode_blob_(f_data[key.mode_bin])
+
+def decode_image_(data, ofs):
+    key = key_
+    f_name, ofs = decode_str_(data, ofs)
+    digest = data[ofs:ofs+HASH_SIZE]
+    ofs += HASH_SIZE
+    if digest != b'\x00'*HASH_SIZE:
+        return ({key.mode_fname : f_name, key.mode_hash : digest.hex()}, ofs)
+    blob, ofs = decode_blob_(data, ofs)
+    return ({key.mode_fname : f_name, key.mode_bin : blob}, ofs)
+
+def encode_str_(s):
+    b = s.encode('utf-8')
+    return U16.pack(len(b)) + b
+
+def decode_str_(data, ofs):
+    n, = U16.unpack_from(data, ofs)
+    ofs += U16.size
+    return (bytes(data[ofs:ofs+n]).decode('utf-8'), ofs + n)
+
+def encode_blob_(b):
+    return U32.pack(len(b)) + bytes(b)
+
+def decode_blob_(data, ofs):
+    n, = U32.unpack_from(data, ofs)
+    ofs += U32.size
+    if ofs + n > len(data):
+        raise ValueError("Truncated blob in packet")
+    return (bytes(data[ofs:ofs+n]), ofs + n)
+
+def encode_value_(v):
+    #型付きの値(None, bool, int, float, str, bytes, list, dict)
+    if v is None:
+        return b'N'
+    if v is True or v is False:
+        return b'T' if v else b'F'
+    if isinstance(v, int) or (hasattr(v, 'dtype') and v.dtype.kind in 'iu'):
+        return b'i' + I64.pack(int(v))
+    if isinstance(v, float) or (hasattr(v, 'dtype') and v.dtype.kind == 'f'):
+        return b'd' + F64.pack(float(v))
+    if isinstance(v, str):
+        b = v.encode('utf-8')
+        return b's' + U32.pack(len(b)) + b
+    if isinstance(v, (bytes, bytearray)):
+        return b'b' + encode_blob_(v)
+    if isinstance(v, (list, tuple)):
+        return b'l' + U32.pack(len(v)) + b''.join(encode_value_(e) for e in v)
+    if isinstance(v, dict):
+        return b'm' + U32.pack(len(v)) + b''.join(encode_value_(k) + encode_value_(e) for k, e in v.items())
+    raise TypeError("Unsupported value type in packet: {0}".format(type(v)))
+
+def decode_value_(data, ofs, depth=0):
+    if depth > MAX_VALUE_DEPTH:
+        raise ValueError("Value nested too deeply in packet")
+    t = data[ofs:ofs+1]
+    ofs += 1
+    if t == b'N':
+        return (None, ofs)
+    if t == b'T' or t == b'F':
+        return (t == b'T', ofs)
+    if t == b'i':
+        return (I64.unpack_from(data, ofs)[0], ofs + I64.size)
+    if t == b'd':
+        return (F64.unpack_from(data, ofs)[0], ofs + F64.size)
+    if t == b's':
+        n, = U32.unpack_from(data, ofs)
+        ofs += U32.size
+        return (bytes(data[ofs:ofs+n]).decode('utf-8'), ofs + n)
+    if t == b'b':
+        return decode_blob_(data, ofs)
+    if t == b'l' or t == b'm':
+        n, = U32.unpack_from(data, ofs)
+        ofs += U32.size
+        if t == b'l':
+            items = []
+            for _ in range(n):
+                e, ofs = decode_value_(data, ofs, depth + 1)
+                items.append(e)
+            return (items, ofs)
+        d = {}
+        for _ in range(n):
+            k, ofs = decode_value_(data, ofs, depth + 1)
+            e, ofs = decode_value_(data, ofs, depth + 1)
+            d[k] = e
+        return (d, ofs)
+    raise ValueError("Unknown value type in packet: {0!r}".format(t))
@@ -74,7 +74,8 @@ class Scenario2Server:
 
         self._is_alive_ = True
         self.init_socket_(scenario_addr[0], scenario_addr[1], timeout)
-        self.client_ = EyesControlClient(ctrl_server_addr[0], ctrl_server_addr[1])
+        #瞳の位置は応答を待たずに送信する(応答は後からまとめて受信する)
+        self.client_ = EyesControlClient(ctrl_server_addr[0], ctrl_server_addr[1], max_in_flight=4)
 
         self.client_.add_modes(r_paths, l_paths, 1)
 
@@ -0,0 +1,218 @@
+'''
+描画処理のベンチマーク
+
+img/とvideo/にある実際の素材を使ってEye, EyeLid, EyesControlServerの描画処理の
+フレームレートと1フレームあたりの処理時間(パーセンタイル)を計測し、JSON形式で出力する。
+出力したJSONを保存しておけば、変更前後の結果を比較できる。
+
+使い方(リポジトリのルートで実行する)
+    python3 src/tool/bench_render.py --duration 3 --output bench.json
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+
+import cv2
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(ROOT_DIR, 'src'))
+
+from libs.lib_donmas_eye import Eye, EyeLid, EyesControlServer
+
+#表示する画像の大きさ(donmas_eye_server.pyと同じ設定)
+SCREEN_HEIGHT   = 720
+SCREEN_WIDTH    = 2*1290
+
+#処理に用いる画像の大きさ
+HEIGHT = 270
+HALF_WIDTH = 480
+WIDTH = HALF_WIDTH*2
+
+PUPIL_PNG_R = 'img/pupil_normal_right.png'
+PUPIL_PNG_L = 'img/pupil_normal_left.png'
+PUPIL_GIF = 'img/pupil_fire_fast.gif'
+EYLID_FILE_PATH = 'video/eyelid_slow.gif'
+EYLID_MASK_FILE_PATH = 'video/bin/eyelid_slow.gif'
+
+def asset(path):
+    return os.path.join(ROOT_DIR, path)
+
+def create_eyes(pupil_r, pupil_l, scale=1.0):
+    bg = 255*np.ones((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    right = Eye(bg, [asset(pupil_r)], min_range=[0, 0],          max_range=[HEIGHT, HALF_WIDTH], th=-18.0, scale=scale)
+    left = Eye(bg, [asset(pupil_l)],  min_range=[0, HALF_WIDTH], max_range=[HEIGHT, WIDTH], th=18.0, scale=scale)
+    return bg, right, left
+
+def create_eyelid(scale=1.0):
+    return EyeLid(cv2.VideoCapture(asset(EYLID_FILE_PATH)),
+                  cv2.VideoCapture(asset(EYLID_MASK_FILE_PATH)), scale=scale)
+
+def keep_blinking(eyelid):
+    #待ち時間なしで瞬きを繰り返す
+    eyelid.set_interval(0.0, 1000000, 0.0)
+
+def measure(step, duration, min_frames=10):
+    '''
+    stepを繰り返し呼び出して1回ごとの処理時間を計測する関数
+
+    Parameters
+    ----------
+    step        : function
+        1フレーム分の処理
+    duration    : float
+        計測時間[sec]
+    min_frames  : int
+        最低限計測するフレーム数
+
+    Returns
+    -------
+    result      : dict
+        計測結果
+    '''
+
+    #初回の確保などの影響を除くため数フレーム空回しする
+    for _ in range(3):
+        step()
+
+    lat = []
+    t_start = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        step()
+        t1 = time.perf_counter()
+        lat.append(t1 - t0)
+        if t1 - t_start >= duration and len(lat) >= min_frames:
+            break
+    elapsed = time.perf_counter() - t_start
+
+    lat_ms = np.array(lat) * 1000.0
+    return {
+        'frames'    : len(lat),
+        'seconds'   : elapsed,
+        'fps'       : len(lat) / elapsed,
+        'latency_ms': {
+            'mean'  : float(lat_ms.mean()),
+            'p50'   : float(np.percentile(lat_ms, 50)),
+            'p90'   : float(np.percentile(lat_ms, 90)),
+            'p99'   : float(np.percentile(lat_ms, 99)),
+            'max'   : float(lat_ms.max())
+        }
+    }
+
+def bench_eye_png(duration):
+    bg, right, _ = create_eyes(PUPIL_PNG_R, PUPIL_PNG_L)
+    return measure(lambda: right.spin_once(bg), duration)
+
+def bench_eye_gif(duration):
+    bg, right, _ = create_eyes(PUPIL_GIF, PUPIL_GIF)
+    return measure(lambda: right.spin_once(bg), duration)
+
+def bench_eyelid_blink(duration):
+    frame = 255*np.ones((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    eyelid = create_eyelid()
+    keep_blinking(eyelid)
+    return measure(lambda: eyelid.spin_once(frame), duration)
+
+def bench_pipeline(duration, incremental=True):
+    #donmas_eye_server.pyの描画処理(get_image + 画面の大きさへの拡大)
+    bg, right, left = create_eyes(PUPIL_PNG_R, PUPIL_PNG_L)
+    eyelid = create_eyelid()
+    server = EyesControlServer(bg, right, left, eyelid, 0, timeout=0.5, incremental=incremental, skip_idle=False)
+    keep_blinking(eyelid)
+
+    def step():
+        eyes = server.get_image()
+        cv2.resize(eyes, dsize=(SCREEN_WIDTH, SCREEN_HEIGHT))
+
+    result = measure(step, duration)
+    server.close()
+    return result
+
+def bench_pipeline_full_redraw(duration):
+    return bench_pipeline(duration, incremental=False)
+
+def bench_pipeline_pooled(duration):
+    #拡大も事前に確保したバッファに書き込む場合
+    bg, right, left = create_eyes(PUPIL_PNG_R, PUPIL_PNG_L)
+    eyelid = create_eyelid()
+    server = EyesControlServer(bg, right, left, eyelid, 0, timeout=0.5, skip_idle=False)
+    keep_blinking(eyelid)
+
+    result = measure(lambda: server.get_scaled_image((SCREEN_WIDTH, SCREEN_HEIGHT)), duration)
+    server.close()
+    return result
+
+def bench_pipeline_native(duration):
+    #素材を事前に拡大して画面の大きさで直接描画する場合
+    scale = (SCREEN_HEIGHT/HEIGHT, SCREEN_WIDTH/WIDTH)
+    bg, right, left = create_eyes(PUPIL_PNG_R, PUPIL_PNG_L, scale)
+    eyelid = create_eyelid(scale)
+    server = EyesControlServer(bg, right, left, eyelid, 0, timeout=0.5, scale=scale, skip_idle=False)
+    keep_blinking(eyelid)
+
+    result = measure(server.get_image, duration)
+    server.close()
+    return result
+
+BENCHMARKS = {
+    'eye_png'               : bench_eye_png,
+    'eye_gif'               : bench_eye_gif,
+    'eyelid_blink'          : bench_eyelid_blink,
+    'pipeline'              : bench_pipeline,
+    'pipeline_full_redraw'  : bench_pipeline_full_redraw,
+    'pipeline_pooled'       : bench_pipeline_pooled,
+    'pipeline_native'       : bench_pipeline_native
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='rendering benchmark of donmas eye')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='measuring time of each benchmark [sec]')
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS.keys()),
+                        help='benchmarks to run (all if omitted)')
+    parser.add_argument('--output', default=None,
+                        help='output JSON file path (stdout if omitted)')
+    args = parser.parse_args()
+
+    names = args.only if args.only else list(BENCHMARKS.keys())
+
+    results = {}
+    #サーバーのログがJSONに混ざらないよう標準エラー出力に回す
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in names:
+            results[name] = BENCHMARKS[name](args.duration)
+            print('{0:24s}: {1:9.1f} fps  p50 {2:.3f} ms  p99 {3:.3f} ms'.format(
+                name, results[name]['fps'],
+                results[name]['latency_ms']['p50'], results[name]['latency_ms']['p99']))
+
+    report = {
+        'meta': {
+            'time'      : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python'    : platform.python_version(),
+            'opencv'    : cv2.__version__,
+            'numpy'     : np.__version__,
+            'machine'   : platform.machine(),
+            'platform'  : platform.platform(),
+            'duration'  : args.duration
+        },
+        'results': results
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+'''
+シナリオの動画書き出しツール
+
+タイムライン(JSON)に書かれた眼の動作をEye, EyeLidとlib_linearの軌道で描画し、動画ファイルに書き出す。
+時計にはシミュレーション用の時計(SimClock)を使うため実時間を待たずに描画でき、
+タイムラインを一定のフレーム数ごとに分割して複数のプロセスで並列に描画する。
+(分割した区間は、それぞれ先頭から区間の開始時刻まで状態だけを進めてから描画を始めるため、
+ 同じタイムラインと乱数の種からは分割数によらず同じ画像が描画される。
+ ただし区間ごとにエンコードするため、区間の境目では画質がわずかに変わることがある。)
+区間の動画は出力と同じ形式(.mp4 または .avi)で書き出し、ffmpegがあれば再エンコードせずに連結する。
+ffmpegが無い場合は全てのフレームを読み直して書き出すため、連結に時間がかかる。
+
+タイムラインの例 : src/tool/sample_timeline.json
+{
+    "fps": 30,                  動画のフレームレート
+    "duration": 20.0,           動画の長さ[sec]
+    "seed": 0,                  瞳の振れと瞬きの間隔に使う乱数の種
+    "curve": "pow3",            瞳の移動の軌道(linear:Proportion, pow3:Pow3)
+    "modes": {                  瞳の表情モードの画像(モード0から順に)
+        "right": ["img/pupil_normal_right.png", ...],
+        "left":  ["img/pupil_normal_left.png", ...]
+    },
+    "events": [                 時刻順でなくてもよい
+        {"t": 0.0, "cmd": "pos", "x": 0.8, "y": 0.5, "dt": 1.0},
+        {"t": 2.0, "cmd": "blink", "period": 3.0, "num": 2},
+        {"t": 4.0, "cmd": "mode", "right": 1, "left": 1}
+    ]
+}
+瞳の移動(pos)は、Scenario2Serverと同様に前の移動が終わるまで次の移動を受け付けない。
+
+使い方(リポジトリのルートで実行する)
+    python3 src/tool/render_scenario.py src/tool/sample_timeline.json preview.mp4 --workers 4
+
+author  : Taiyou Komazawa
+date    : 2022/11/21
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(os.path.join(ROOT_DIR, 'src'))
+
+from libs.lib_donmas_eye import Eye, EyeLid, SimClock, Proportion, Pow3, scale_image
+
+#処理に用いる画像の大きさ(donmas_eye_server.pyと同じ設定)
+HEIGHT = 270
+HALF_WIDTH = 480
+WIDTH = HALF_WIDTH*2
+
+EYLID_FILE_PATH = 'video/eyelid_slow.gif'
+EYLID_MASK_FILE_PATH = 'video/bin/eyelid_slow.gif'
+
+DEFAULT_MODES = {
+    'right': ['img/pupil_normal_right.png'],
+    'left' : ['img/pupil_normal_left.png']
+}
+
+def asset(path):
+    return os.path.join(ROOT_DIR, path)
+
+#タイムラインに従って眼の状態を進め、1フレームずつ描画するクラス
+class TimelinePlayer:
+
+    def __init__(self, timeline, scale):
+        '''
+        クラスコンストラクタ
+
+        Parameters
+        ----------
+        timeline    : dict
+            タイムライン
+
+        scale       : (float, float)
+            出力画像の拡大率(縦方向, 横方向)
+        '''
+
+        self.fps_ = timeline['fps']
+        self.events_ = sorted(timeline.get('events', []), key=lambda e: e['t'])
+        self.ev_idx_ = 0
+
+        modes = timeline.get('modes', DEFAULT_MODES)
+        seed = timeline.get('seed', 0)
+
+        #軌道はリセットした時刻から経過時間を測るため、時計は描画開始(0秒)より前から始めておく
+        self.clock_ = SimClock(-1.0)
+
+        self.bg_ = 255*np.ones((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        self.right_ = Eye(self.bg_, [asset(p) for p in modes['right']], min_range=[0, 0],
+                          max_range=[HEIGHT, HALF_WIDTH], th=-18.0, scale=scale,
+                          clock=self.clock_, rng=random.Random(seed))
+        self.left_ = Eye(self.bg_, [asset(p) for p in modes['left']], min_range=[0, HALF_WIDTH],
+                         max_range=[HEIGHT, WIDTH], th=18.0, scale=scale,
+                         clock=self.clock_, rng=random.Random(seed+1))
+        self.eyelid_ = EyeLid(cv2.VideoCapture(asset(EYLID_FILE_PATH)),
+                              cv2.VideoCapture(asset(EYLID_MASK_FILE_PATH)), scale=scale,
+                              clock=self.clock_, rng=random.Random(seed+2))
+        self.eyelid_.set_interval(3, 2)
+
+        if timeline.get('curve', 'linear') == 'pow3':
+            self.curve_ = (Pow3(0.5, self.clock_), Pow3(0.5, self.clock_))
+        else:
+            self.curve_ = (Proportion(0.5, self.clock_), Proportion(0.5, self.clock_))
+
+        self.bg_ = scale_image(self.bg_, scale)
+        self.frame_ = self.bg_.copy()
+
+    def step(self, frame_no, draw=True):
+        '''
+        指定したフレームの時刻まで状態を進めて描画する関数
+
+        Parameters
+        ----------
+        frame_no    : int
+            フレーム番号(0から)
+
+        draw        : bool
+            Falseの場合は状態を進めるだけで描画しない(区間の開始時刻まで早送りする場合)
+
+        Returns
+        -------
+        frame       : ndarray or None
+            描画された画像(内部のバッファであり、次の呼び出しで上書きされる), drawがFalseの場合None
+        '''
+
+        t = frame_no / self.fps_
+        self.clock_.set(t)
+
+        while self.ev_idx_ < len(self.events_) and self.events_[self.ev_idx_]['t'] <= t:
+            self.apply_event_(self.events_[self.ev_idx_])
+            self.ev_idx_ += 1
+
+        x = self.curve_[0].get_out()[0]
+        y = self.curve_[1].get_out()[0]
+        self.right_.set_pos(y, x)
+        self.left_.set_pos(y, x)
+
+        #乱数と時刻による状態の更新は、描画する場合としない場合で同じ順番で行う
+        self.right_.update()
+        self.left_.update()
+        self.eyelid_.update()
+        if not draw:
+            return None
+
+        np.copyto(self.frame_, self.bg_)
+        self.right_.blit(self.frame_)
+        self.left_.blit(self.frame_)
+        self.eyelid_.blit(self.frame_)
+
+        return self.frame_
+
+    def apply_event_(self, ev):
+        cmd = ev['cmd']
+        if cmd == 'pos':
+            self.curve_[0].reset(ev['x'], ev['dt'])
+            self.curve_[1].reset(ev['y'], ev['dt'])
+        elif cmd == 'blink':
+            self.eyelid_.set_interval(ev['period'], ev.get('num', 2))
+        elif cmd == 'mode':
+            self.right_.change_mode(ev['right'])
+            self.left_.change_mode(ev['left'])
+        else:
+            raise ValueError("Unknown timeline command: {0}".format(cmd))
+
+def render_chunk(timeline, begin, end, size, path):
+    '''
+    タイムラインのフレーム[begin, end)を動画ファイルに書き出す関数(ワーカープロセスで実行される)
+
+    Parameters
+    ----------
+    timeline    : dict
+        タイムライン
+
+    begin, end  : int
+        描画するフレーム番号の範囲
+
+    size        : (int, int)
+        出力画像の大きさ(幅, 高さ)
+
+    path        : string
+        書き出し先の動画ファイルパス
+
+    Returns
+    -------
+    path        : string
+        書き出した動画ファイルパス
+    '''
+
+    scale = (size[1]/HEIGHT, size[0]/WIDTH)
+    player = TimelinePlayer(timeline, scale)
+
+    #区間の開始時刻まで状態だけを進める(描画しないため、区間の長さに比べて十分に速い)
+    for frame_no in range(begin):
+        player.step(frame_no, draw=False)
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*chunk_fourcc(path)), timeline['fps'], size)
+    for frame_no in range(begin, end):
+        writer.write(player.step(frame_no))
+    writer.release()
+
+    return path
+
+def chunk_fourcc(path):
+    #区間の動画は出力と同じ形式で書き出す(ffmpegで再エンコードせずに連結できるように)
+    return 'mp4v' if path.endswith('.mp4') else 'MJPG'
+
+def concat_chunks(paths, output, fps, size):
+    #ffmpegがあれば再エンコードせずに連結し、なければOpenCVで読み直して書き出す
+    #(ffmpegが無い場合は全てのフレームを親プロセスで順に再エンコードするため遅い)
+    if shutil.which('ffmpeg') is not None:
+        list_path = os.path.join(os.path.dirname(paths[0]), 'chunks.txt')
+        with open(list_path, 'w') as f:
+            for path in paths:
+                f.write("file '{0}'\n".format(path))
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', list_path, '-c', 'copy', output], check=True)
+        return
+
+    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*chunk_fourcc(output)), fps, size)
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.write(frame)
+        cap.release()
+    writer.release()
+
+def main():
+    parser = argparse.ArgumentParser(description='render a donmas eye timeline to a video file')
+    parser.add_argument('timeline', help='timeline JSON file')
+    parser.add_argument('output', help='output video file (.mp4 or .avi)')
+    parser.add_argument('--width', type=int, default=WIDTH, help='output width')
+    parser.add_argument('--height', type=int, default=HEIGHT, help='output height')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-sec', type=float, default=10.0, help='length of a chunk rendered by one task [sec]')
+    args = parser.parse_args()
+
+    with open(args.timeline) as f:
+        timeline = json.load(f)
+    timeline.setdefault('fps', 30)
+
+    frame_num = int(round(timeline['duration'] * timeline['fps']))
+    chunk = max(1, int(round(args.chunk_sec * timeline['fps'])))
+    size = (args.width, args.height)
+
+    t_start = time.perf_counter()
+    tmp_dir = tempfile.mkdtemp(prefix='donmas_eye_')
+    try:
+        ranges = [(b, min(b+chunk, frame_num)) for b in range(0, frame_num, chunk)]
+        ext = '.mp4' if args.output.endswith('.mp4') else '.avi'
+        paths = [os.path.join(tmp_dir, 'chunk_{0:05d}{1}'.format(i, ext)) for i in range(len(ranges))]
+
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(render_chunk, timeline, b, e, size, path)
+                       for (b, e), path in zip(ranges, paths)]
+            for future in futures:
+                future.result()
+
+        concat_chunks(paths, args.output, timeline['fps'], size)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    elapsed = time.perf_counter() - t_start
+    print('Rendered {0} frames ({1:.1f} sec) in {2:.1f} sec with {3} chunks.'.format(
+        frame_num, timeline['duration'], elapsed, len(ranges)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+コントロールサーバーのメッセージ処理のテスト
+
+パイプライン送信された瞳の位置が顔ごとにまとめて反映されること,
+応答がまとめて(最新のデータIDで)返されること, 受信した順に反映されることを確かめる。
+'''
+
+import io
+import os
+import sys
+import socket
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import cv2
+import numpy as np
+
+from libs.lib_donmas_eye import Eye, EyeLid, EyesControlServer, EyesControlClient, AsyncEyesControlClient
+from libs.lib_donmas_eye import AssetStore
+
+HEIGHT = 270
+HALF_WIDTH = 480
+WIDTH = HALF_WIDTH*2
+
+#パイプライン送信するメッセージ数
+MESSAGE_NUM = 1000
+
+def asset_path(path):
+    return os.path.join(ROOT, path)
+
+class ServerCoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        #サーバーの受信ログは表示しない
+        self.stack_ = contextlib.ExitStack()
+        self.stack_.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        tmp_dir = self.stack_.enter_context(tempfile.TemporaryDirectory())
+
+        bg = 255*np.ones((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        assets = AssetStore(tmp_dir + '/')
+        right = Eye(bg, [asset_path('img/pupil_normal_right.png')], min_range=[0, 0], max_range=[HEIGHT, HALF_WIDTH], th=-18.0, assets=assets)
+        left = Eye(bg, [asset_path('img/pupil_normal_left.png')], min_range=[0, HALF_WIDTH], max_range=[HEIGHT, WIDTH], th=18.0, assets=assets)
+        self.eyelid_img_ = cv2.VideoCapture(asset_path('video/eyelid_slow.gif'))
+        self.eyelid_m_img_ = cv2.VideoCapture(asset_path('video/bin/eyelid_slow.gif'))
+        eyelid = EyeLid(self.eyelid_img_, self.eyelid_m_img_)
+
+        #空いているポートで起動する(IPv4とIPv6で別の番号になるため、IPv4の番号を使う)
+        self.server_ = EyesControlServer(bg, right, left, eyelid, 0, assets=assets)
+        self.port_ = next(sock.getsockname()[1] for sock in self.server_.server_.sockets
+                          if sock.family == socket.AF_INET)
+
+        #公開されたスナップショットの数を数える
+        self.publish_cnt_ = 0
+        publish = self.server_.publish_
+        def count_publish(*args, **kwargs):
+            self.publish_cnt_ += 1
+            return publish(*args, **kwargs)
+        self.server_.publish_ = count_publish
+
+    def tearDown(self):
+        self.server_.close()
+        self.eyelid_img_.release()
+        self.eyelid_m_img_.release()
+        self.stack_.close()
+
+    def test_async_pipelined_positions(self):
+        async def run():
+            client = AsyncEyesControlClient('127.0.0.1', self.port_, max_in_flight=64)
+            await client.connect()
+            try:
+                futures = [await client.set_pos(i/MESSAGE_NUM, 0.5) for i in range(MESSAGE_NUM)]
+                await client.flush()
+                return [future.result() for future in futures]
+            finally:
+                await client.close()
+
+        resps = asyncio.run(run())
+
+        #まとめて届いた位置は1回の公開にまとめられる
+        self.assertLess(self.publish_cnt_, MESSAGE_NUM // 2)
+        #最後に送った位置が反映されている
+        self.assertEqual(self.server_.faces_[0].state_.pos, (0.5, (MESSAGE_NUM - 1)/MESSAGE_NUM))
+        #全てのコマンドに応答があり、最後の応答は最後に送ったデータIDを返す
+        self.assertEqual(resps[-1]['data-id'], max(resp['data-id'] for resp in resps))
+
+    def test_sync_cumulative_ack(self):
+        client = EyesControlClient('127.0.0.1', self.port_, max_in_flight=16)
+        for i in range(MESSAGE_NUM):
+            client.set_pos(i/MESSAGE_NUM, 0.25)
+        client.flush()
+
+        self.assertEqual(client.numof_in_flight(), 0)
+        self.assertEqual(self.server_.faces_[0].state_.pos, (0.25, (MESSAGE_NUM - 1)/MESSAGE_NUM))
+        del client
+
+    def test_position_after_mode_change(self):
+        #表情モードの変更(瞳を中心に戻す)の後に届いた位置は失われない
+        async def run():
+            client = AsyncEyesControlClient('127.0.0.1', self.port_, max_in_flight=64)
+            await client.connect()
+            try:
+                await client.set_pos(0.2, 0.8)
+                await client.set_mode(0, 0)
+                await client.set_pos(0.9, 0.1)
+                await client.flush()
+            finally:
+                await client.close()
+
+        asyncio.run(run())
+
+        state = self.server_.faces_[0].state_
+        self.assertEqual(state.pos, (0.1, 0.9))
+        self.assertGreater(state.pos_seq, state.mode_seq)
+
+if __name__ == '__main__':
+    unittest.main()
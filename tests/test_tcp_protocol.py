@@ -0,0 +1,97 @@
+'''
+通信プロトコル(lib_tcp_protocol)のテスト
+
+バイナリ形式の変換, pickle形式の安全な読み込み, 入れ子の深さの制限を確かめる。
+'''
+
+import os
+import sys
+import pickle
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from libs.lib_tcp_protocol import *
+from libs.donmas_eye_server_keys import HeaderKey as Key
+
+def payload_(data):
+    #データ長を取り除いたペイロードを返す
+    (size,) = struct.unpack('>L', data[:4])
+    return data[4:4+size]
+
+class BinaryFormatTest(unittest.TestCase):
+
+    def round_trip_(self, packets):
+        r_dict, is_binary = parse_message(payload_(frame_message(packets, binary=True)))
+        self.assertTrue(is_binary)
+        return r_dict
+
+    def test_state_packets(self):
+        packets = {
+            Key().data_id       : 12,
+            Key().face_id       : 1,
+            Key().x_pos         : 0.25,
+            Key().y_pos         : 0.75,
+            Key().blink_period  : 3.0,
+            Key().blink_num     : 2,
+            Key().right_mode    : 1,
+            Key().left_mode     : 0
+        }
+        self.assertEqual(self.round_trip_(packets), packets)
+
+    def test_image_and_values(self):
+        packets = {
+            Key().data_id       : 3,
+            Key().rl_mode_img   : {Key().mode_fname : 'pupil.png', Key().mode_bin : b'\x00\x01\xff'},
+            Key().mode_id       : -1,
+            Key().stats         : True,
+            'extra'             : [None, 'a', 1.5, {'k' : b'v'}]
+        }
+        self.assertEqual(self.round_trip_(packets), packets)
+
+    def test_fixed_record_fallback(self):
+        #固定長のレコードに収まらない値(範囲外の整数, 小数)も値のまま復元される
+        packets = {Key().face_id : 2**40, Key().blink_period : 3, Key().blink_num : 2.0}
+        r_dict = self.round_trip_(packets)
+        self.assertEqual(r_dict, packets)
+        self.assertIs(type(r_dict[Key().blink_num]), float)
+
+    def test_pickle_is_still_accepted(self):
+        packets = {Key().data_id : 5, Key().x_pos : 0.1, Key().y_pos : 0.2}
+        r_dict, is_binary = parse_message(payload_(frame_message(packets)))
+        self.assertFalse(is_binary)
+        self.assertEqual(r_dict, packets)
+
+class MalformedMessageTest(unittest.TestCase):
+
+    def test_forbidden_pickle_global(self):
+        class Evil:
+            def __reduce__(self):
+                return (print, ('pwned',))
+
+        data = pickle.dumps({Key().data_id : 1, 'x' : Evil()}, 0)
+        with self.assertRaises(ProtocolError):
+            parse_message(data)
+
+    def test_value_depth_limit(self):
+        value = []
+        for _ in range(MAX_VALUE_DEPTH + 8):
+            value = [value]
+        data = encode_packets({'nested' : value})
+        with self.assertRaises(ProtocolError):
+            parse_message(data)
+
+    def test_value_within_depth_limit(self):
+        value = []
+        for _ in range(MAX_VALUE_DEPTH - 1):
+            value = [value]
+        self.assertEqual(parse_message(encode_packets({'nested' : value}))[0], {'nested' : value})
+
+    def test_truncated_message(self):
+        data = encode_packets({Key().data_id : 1, Key().x_pos : 0.5, Key().y_pos : 0.5})
+        with self.assertRaises(ProtocolError):
+            parse_message(data[:-3])
+
+if __name__ == '__main__':
+    unittest.main()